@@ -1,13 +1,35 @@
 from django.conf.urls.defaults import *
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.core.urlresolvers import reverse
 from django import forms
 from django.http import HttpResponseRedirect
 from .models import Message
 from .router import get_router
 
+class MessageChangeList(ChangeList):
+    """
+    Runs the search box through Message.objects.search so that text searches can use
+    the trigram index when ROUTER_TRIGRAM_SEARCH is on.
+    """
+
+    def get_query_set(self):
+        query, self.query = self.query, ''
+        try:
+            qs = super(MessageChangeList, self).get_query_set()
+        finally:
+            self.query = query
+
+        if query:
+            qs = qs.search(query.split(), fields=self.search_fields)
+        return qs
+
+
 class MessageAdmin(admin.ModelAdmin):
 
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
+
     def get_urls(self):
         urls = super(MessageAdmin, self).get_urls()
         console_urls = patterns('', (r'^send/$', self.admin_site.admin_view(self.send), {}, 'rapidsms_httprouter_message_send'))
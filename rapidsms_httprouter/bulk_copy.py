@@ -0,0 +1,69 @@
+"""
+Loads rows with PostgreSQL's COPY instead of parameterised INSERTs, which is several
+times faster for large numbers of rows and avoids building huge query strings.
+
+COPY is used whenever the database is PostgreSQL unless ROUTER_BULK_COPY = False,
+callers fall back to INSERTs on other engines.
+"""
+import datetime
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.db import connections
+
+from .databases import is_postgresql
+
+
+def copy_enabled(using='default'):
+    return getattr(settings, 'ROUTER_BULK_COPY', True) and is_postgresql(using)
+
+
+def csv_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        value = value and 't' or 'f'
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        value = value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return '"%s"' % value.replace('"', '""')
+
+
+def build_buffer(rows):
+    """
+    Writes the passed in rows to an in memory CSV buffer, NULLs are written unquoted
+    as \\N so that they can be told apart from empty strings.
+    """
+    buf = StringIO()
+    for row in rows:
+        buf.write(','.join([csv_value(value) for value in row]))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    COPYs the passed in rows into table, returning how many were loaded.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+
+    qn = connections['default'].ops.quote_name
+    sql = "COPY %s (%s) FROM STDIN WITH CSV NULL '\\N'" % (qn(table), ', '.join([qn(c) for c in columns]))
+    cursor.copy_expert(sql, build_buffer(rows))
+    return len(rows)
+
+
+def reserve_ids(cursor, table, count):
+    """
+    Takes count ids out of the sequence of table, so that rows loaded through COPY can
+    be given their ids up front like an INSERT ... RETURNING would.
+    """
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                   [table, count])
+    return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    A small thread safe, size bounded, least recently used cache with an optional
+    time to live for entries.
+
+    Entries can be tagged when they are set, which lets callers drop every key that
+    refers to the same underlying object (ie, a model primary key) in one call.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires, tag = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.time():
+                self._untag(key, tag)
+                return default
+
+            # re-insert so that this key becomes the most recently used
+            self._entries[key] = (value, expires, tag)
+            return value
+
+    def set(self, key, value, tag=None):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._untag(key, self._entries.pop(key)[2])
+
+            expires = time.time() + self.ttl if self.ttl else None
+            self._entries[key] = (value, expires, tag)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                old_key, (old_value, old_expires, old_tag) = self._entries.popitem(last=False)
+                self._untag(old_key, old_tag)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._untag(key, self._entries.pop(key)[2])
+
+    def delete_tag(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _untag(self, key, tag):
+        if tag is not None and tag in self._tags:
+            self._tags[tag].discard(key)
+            if not self._tags[tag]:
+                del self._tags[tag]
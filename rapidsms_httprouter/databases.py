@@ -0,0 +1,14 @@
+"""
+Tells apart the database engines we have faster code paths for.  Uses the vendor of the
+connection rather than its ENGINE setting, so that PostGIS and other backends built on
+the PostgreSQL one are treated the same.
+"""
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+def is_postgresql(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'postgresql'
+
+
+def is_sqlite(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'sqlite'
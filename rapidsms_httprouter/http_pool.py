@@ -0,0 +1,96 @@
+"""
+Keeps a pooled, keep-alive requests.Session per router url host so that sending a
+chunk doesn't pay for a new TCP (and TLS) handshake every time.
+
+Sessions are configured per backend through ROUTER_HTTP_CONFIG, ie:
+
+    ROUTER_HTTP_CONFIG = {
+        'default': {'pool_size': 10, 'connect_timeout': 5, 'read_timeout': 15},
+        'aggregator': {'retries': 3, 'backoff_factor': 0.5, 'read_timeout': 30},
+    }
+"""
+from threading import Lock
+from urlparse import urlparse
+
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_HTTP_CONFIG = {
+    'pool_size': 10,
+    'keep_alive': True,
+    'retries': 0,
+    'backoff_factor': 0,
+    'connect_timeout': 5,
+    'read_timeout': 15,
+}
+
+
+def get_http_config(backend_name=None):
+    configs = getattr(settings, 'ROUTER_HTTP_CONFIG', {})
+    config = dict(DEFAULT_HTTP_CONFIG)
+    config.update(configs.get('default', {}))
+    if backend_name:
+        config.update(configs.get(backend_name, {}))
+    return config
+
+
+def build_retries(config):
+    """
+    Only connection failures are retried, a request which timed out reading the response
+    may well have been accepted, and retrying it would double send.
+    """
+    try:
+        from requests.packages.urllib3.util.retry import Retry
+    except ImportError:
+        return config['retries']
+
+    return Retry(total=config['retries'], connect=config['retries'], read=0, redirect=0,
+                 backoff_factor=config['backoff_factor'])
+
+
+class SessionPool(object):
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = Lock()
+
+    def get_session(self, url, config):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc, tuple(sorted(config.items())))
+
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['pool_size'],
+                                      max_retries=build_retries(config))
+                session.mount('%s://' % parsed.scheme, adapter)
+                if not config['keep_alive']:
+                    session.headers['Connection'] = 'close'
+                self.sessions[key] = session
+
+        return session
+
+    def fetch(self, url, backend_name=None):
+        """
+        Calls the passed in url, either a string which is fetched with a GET or a dict of
+        arguments for a POST, and returns the status code of the response.
+        """
+        config = get_http_config(backend_name)
+        timeout = (config['connect_timeout'], config['read_timeout'])
+
+        if type(url) is dict:
+            kwargs = dict(url)
+            kwargs.setdefault('timeout', timeout)
+            return self.get_session(kwargs['url'], config).post(**kwargs).status_code
+        else:
+            return self.get_session(url, config).get(url, timeout=timeout).status_code
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+session_pool = SessionPool()
@@ -3,47 +3,129 @@ from optparse import make_option
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import connections, router, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Max
 
 from rapidsms.models import Connection, Backend
-from rapidsms_httprouter.router import HttpRouter
+from rapidsms_httprouter.databases import is_postgresql
+from rapidsms_httprouter.router import HttpRouter, clear_cached_instances
 from datetime import datetime
 
 import traceback
 
+# normalizes identities the same way HttpRouter.normalize_number does
+NORMALIZED_SQL = "regexp_replace(lower(identity), '[^0-9a-z]', '', 'g')"
+
+
 class Command(BaseCommand):
     help = 'Normalizes all connections in the database, removing everything except digits.'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='How many connection ids to normalize per transaction.'),
+        make_option('--start-id', type='int', dest='start_id', default=0,
+                    help='Resume from this connection id, as printed by a previous run.'),
+        make_option('--row-by-row', action='store_true', dest='row_by_row', default=False,
+                    help='Normalize the connections in Python even on PostgreSQL.'),
+    )
+
     def handle(self, *files, **options):
-        connection = connections[DEFAULT_DB_ALIAS]
+        batch_size = options['batch_size']
+
+        if is_postgresql(DEFAULT_DB_ALIAS) and not options['row_by_row']:
+            normalize_batch = self.normalize_batch_sql
+        else:
+            normalize_batch = self.normalize_batch
+
+        max_id = Connection.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+        remapped = skipped = 0
+
+        # every range of ids is normalized and committed on its own, so an interrupted run
+        # can be picked up again with --start-id, rows which were already normalized are
+        # never touched again either way
+        start_id = options['start_id']
+        while start_id <= max_id:
+            end_id = start_id + batch_size
+            batch_remapped, batch_skipped = normalize_batch(start_id, end_id)
+            remapped += batch_remapped
+            skipped += batch_skipped
+
+            print "%s: normalized ids up to %d of %d, %d remapped, %d skipped because of a collision, " \
+                  "resume with --start-id=%d" % (datetime.now(), min(end_id, max_id + 1) - 1, max_id,
+                                                 remapped, skipped, end_id)
+            start_id = end_id
+
+        # identities were changed with update(), anything cached in this process is stale now
+        clear_cached_instances()
+
+        print "done, %d remapped, %d skipped because of a collision" % (remapped, skipped)
+
+    @transaction.commit_on_success
+    def normalize_batch_sql(self, start_id, end_id):
+        """
+        Normalizes the connections with ids in [start_id, end_id) in the database.  When
+        several connections of a backend normalize to the same identity only the one
+        with the lowest id is remapped.  As before, connections whose normalized
+        identity already exists are left alone, it is too difficult to know who might
+        have a reference to them in the system to remap.
+        """
+        cursor = connections[DEFAULT_DB_ALIAS].cursor()
+        table = Connection._meta.db_table
+
+        cursor.execute("""
+            WITH changed AS (
+                SELECT id, backend_id, normalized FROM (
+                    SELECT id, backend_id, identity, %(normalized)s AS normalized
+                    FROM %(table)s WHERE id >= %%s AND id < %%s
+                ) batch
+                WHERE identity <> normalized
+            ), remappable AS (
+                SELECT min(id) AS id, normalized FROM changed
+                WHERE NOT EXISTS (SELECT 1 FROM %(table)s existing
+                                  WHERE existing.backend_id = changed.backend_id
+                                  AND existing.identity = changed.normalized)
+                GROUP BY backend_id, normalized
+            )
+            UPDATE %(table)s SET identity = remappable.normalized FROM remappable
+            WHERE %(table)s.id = remappable.id
+        """ % dict(table=table, normalized=NORMALIZED_SQL), [start_id, end_id])
+        remapped = cursor.rowcount
 
-        # Start transaction management. All fixtures are installed in a
-        # single transaction to ensure that all references are resolved.
-        transaction.commit_unless_managed()
-        transaction.enter_transaction_management()
-        transaction.managed(True)
+        # whatever is still not normalized collided
+        cursor.execute("SELECT count(*) FROM %(table)s WHERE id >= %%s AND id < %%s AND identity <> %(normalized)s"
+                       % dict(table=table, normalized=NORMALIZED_SQL), [start_id, end_id])
+        skipped = cursor.fetchone()[0]
 
-        # for every connection
-        for connection in Connection.objects.all():
-            # try normalizing the number
-            normalized = HttpRouter.normalize_number(connection.identity)
+        return remapped, skipped
 
-            # if it is different, then we changed it, first check to see
-            # if there is a connection that is identical.  In that case we don't
-            # change anything, it is too difficult to know who might have a reference
-            # to this connection in the system to remap.
-            if normalized != connection.identity:
-                collision = Connection.objects.filter(identity=normalized, backend=connection.backend)
+    @transaction.commit_on_success
+    def normalize_batch(self, start_id, end_id):
+        """
+        Same as normalize_batch_sql, for databases without regexp_replace.
+        """
+        rows = list(Connection.objects.filter(id__gte=start_id, id__lt=end_id).order_by('id')
+                                      .values_list('id', 'backend_id', 'identity'))
+        normalized_identities = HttpRouter.normalize_numbers(identity for pk, backend_id, identity in rows)
 
-                # no collision!  Ok, we can just save our new identity
-                if not collision:
-                    print "remapping %s to %s" % (connection.identity, normalized)
-                    
-                    connection.identity = normalized
-                    connection.save()
+        changed = []
+        for (pk, backend_id, identity), normalized in zip(rows, normalized_identities):
+            if normalized != identity:
+                changed.append((pk, backend_id, identity, normalized))
 
-                else:
-                    print "skipping %s, collision" % (connection.identity)
+        if not changed:
+            return 0, 0
 
-        transaction.commit()
+        taken = set(Connection.objects.filter(identity__in=set(row[3] for row in changed))
+                                      .values_list('backend_id', 'identity'))
 
+        remapped = skipped = 0
+        for pk, backend_id, identity, normalized in changed:
+            if (backend_id, normalized) in taken:
+                print "skipping %s, collision" % identity
+                skipped += 1
+            else:
+                print "remapping %s to %s" % (identity, normalized)
+                Connection.objects.filter(pk=pk).update(identity=normalized)
+                taken.add((backend_id, normalized))
+                remapped += 1
 
+        return remapped, skipped
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import copy
+import threading
 import traceback
 import time
+from optparse import make_option
 from urllib import quote_plus
 import urllib2
 
 from django.core.management.base import BaseCommand
 from django.db.models import Q
+from django.utils.datastructures import SortedDict
 from django.conf import settings
 from django.core.mail import send_mail
 from django.db import transaction, close_connection
@@ -15,20 +19,66 @@ from rapidsms_httprouter.models import Message, MessageBatch
 from rapidsms.log.mixin import LoggerMixin
 import requests
 from rapidsms_httprouter.router import get_router
+from rapidsms_httprouter import ratelimit
+from rapidsms_httprouter.http_pool import session_pool
+from rapidsms_httprouter.databases import is_postgresql
+from rapidsms_httprouter.notify import notify_enabled, OutboxListener
 from rapidsms_httprouter_src.rapidsms_httprouter.utils import replace_characters, stringify
 
 
+class BackendRegistry(object):
+    """
+    Keeps the backend instances built from BACKENDS_CONFIGURATION around between chunks,
+    an entry is only rebuilt when the configuration of its backend changes.
+    """
+
+    def __init__(self):
+        self.backends = {}
+        self.lock = threading.Lock()
+
+    def get(self, backend_name, backend_config, build):
+        with self.lock:
+            config, backend = self.backends.get(backend_name, (None, None))
+            if backend is None or config != backend_config:
+                backend = build(backend_config, backend_name)
+                self.backends[backend_name] = (copy.deepcopy(backend_config), backend)
+            return backend
+
+    def clear(self):
+        with self.lock:
+            self.backends = {}
+
+backend_registry = BackendRegistry()
+
+
 class Command(BaseCommand, LoggerMixin):
     help = """sends messages from all project DBs
     """
 
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrent', action='store_true', dest='concurrent', default=False,
+                    help='Send for every database in its own thread.'),
+    )
+
+    # whether the current loop managed to send (or discard) any messages
+    made_progress = False
+
+    # the backend of the chunk currently being sent
+    backend_name = None
+
+    # the batch currently being sent, None when sending individual messages
+    batch_id = None
+
     def fetch_url(self, url):
         """
         Wrapper around url open, mostly here so we can monkey patch over it in unit tests.
         """
         self.info("URL ------------->")
         self.info(url)
-        if type(url) is dict:
+        if getattr(settings, 'ROUTER_HTTP_POOLING', False):
+            code = session_pool.fetch(url, self.backend_name)
+            self.info(code)
+        elif type(url) is dict:
 
             r = requests.post(**url)
             code = r.status_code
@@ -98,7 +148,11 @@ class Command(BaseCommand, LoggerMixin):
         except:
             return None
 
-    def send_backend_chunk(self, router_url, pks, backend_name, priority):
+    def get_chunk_messages(self, pks, backend_name):
+        """
+        Returns the sendable messages out of the passed in chunk, or None if the
+        backend isn't supported, in which case the messages are marked as such.
+        """
         supported_backends = getattr(settings, 'SUPPORTED_BACKENDS', None)
 
         msgs = Message.objects.using(self.db_key).filter(pk__in=pks)
@@ -108,57 +162,157 @@ class Command(BaseCommand, LoggerMixin):
 
         if supported_backends is not None and backend_name not in supported_backends:
             self.info("SMS%s have unsupported backends" % pks)
-            msgs.update(status='B')
+            self.update_status(msgs, 'B')
+            return None
+
+        return msgs
+
+    def build_chunk_url(self, router_url, msgs, backend_name, priority):
+        rows = list(msgs.values_list('pk', 'connection__identity'))
+        recipients_list = [identity for pk, identity in rows]
+        self.info("%s " % (type(recipients_list)))
+
+        # lets the dlr url in the router url identify the messages receipts are for, see delivery_report
+        receipt_token = Message.receipt_token([pk for pk, identity in rows])
+        msgs.update(receipt_chunk=receipt_token)
+        return self.build_send_url(router_url, backend_name, recipients_list, msgs[0].text, priority=str(priority),
+                                   id=receipt_token)
+
+    def update_status(self, msgs, status):
+        """
+        Moves the passed in messages to a final status, keeping the counters of the batch
+        being sent up to date in the process.
+        """
+        count = msgs.update(status=status)
+        MessageBatch.count_transition(self.batch_id, status, count, using=self.db_key)
+
+    def throttle(self, backend_name, cost):
+        """
+        Waits until the rate limit of the backend allows sending cost more messages.
+        """
+        ratelimit.throttle(backend_name, cost)
+
+    def update_chunk_status(self, msgs, pks, status_code):
+        """
+        Updates the status of a chunk of messages based on the response to sending them.
+        """
+        # kannel likes to send 202 responses, really any
+        # 2xx value means things went okay
+        if int(status_code / 100) == 2:
+            self.info("SMS%s SENT" % pks)
+            self.update_status(msgs, 'S')
+            self.made_progress = True
+        elif int(status_code) == 403:
+            self.info("SMS%s DISCARDED BY KANNEL... Taken out of queue")
+            self.update_status(msgs, 'K')
+            self.made_progress = True
+        else:
+            self.info("SMS%s Message not sent, got status: %s .. queued for later delivery." % (pks, status_code))
+            msgs.update(status='Q')
+
+    def send_backend_chunk(self, router_url, pks, backend_name, priority):
+        msgs = self.get_chunk_messages(pks, backend_name)
+        if msgs is None:
             return
 
+        self.backend_name = backend_name
         try:
-            recipients_list = list(msgs.values_list('connection__identity', flat=True))
-            self.info("%s " % (type(recipients_list)))
-            url = self.build_send_url(router_url, backend_name,recipients_list, msgs[0].text, priority=str(priority))
+            url = self.build_chunk_url(router_url, msgs, backend_name, priority)
 
+            self.throttle(backend_name, len(pks))
             status_code = self.fetch_url(url)
 
-            # kannel likes to send 202 responses, really any
-            # 2xx value means things went okay
-            if int(status_code / 100) == 2:
-                self.info("SMS%s SENT" % pks)
-                msgs.update(status='S')
-            elif int(status_code) == 403:
-                self.info("SMS%s DISCARDED BY KANNEL... Taken out of queue")
-                msgs.update(status='K')
-            else:
-                self.info("SMS%s Message not sent, got status: %s .. queued for later delivery." % (pks, status_code))
-                msgs.update(status='Q')
+            self.update_chunk_status(msgs, pks, status_code)
 
         except Exception as e:
             self.error("SMS%s Message not sent: %s .. queued for later delivery." % (pks, str(e)))
             msgs.update(status='Q')
 
-    def send_all(self, router_url, to_send, priority):
+    def group_by_backend(self, to_send):
+        """
+        Splits the passed in messages into lists of pks of consecutive messages with the
+        same backend.
+        """
         pks = []
         if len(to_send):
             backend_name = to_send[0].connection.backend.name
             for msg in to_send:
                 if backend_name != msg.connection.backend.name:
-                    # send all of the same backend
-                    self.send_backend_chunk(router_url, pks, backend_name, priority)
+                    yield backend_name, pks
                     # reset the loop status variables to build the next chunk of messages with the same backend
                     backend_name = msg.connection.backend.name
                     pks = [msg.pk]
                 else:
                     pks.append(msg.pk)
+            yield backend_name, pks
+
+    def send_all(self, router_url, to_send, priority):
+        # send all of the same backend
+        for backend_name, pks in self.group_by_backend(to_send):
             self.send_backend_chunk(router_url, pks, backend_name, priority)
 
+    def send_groups(self, router_url, groups, priority):
+        """
+        Sends every one of the passed in groups of messages, each as its own chunks.
+        """
+        for to_send in groups:
+            self.send_all(router_url, to_send, priority)
+
+    def claim(self, to_process, limit):
+        """
+        Returns up to limit of the queued messages in to_process for us to send.  With
+        SEND_MESSAGES_LEASING they are first leased, so that several senders can safely
+        work on the same database.
+        """
+        if not getattr(settings, 'SEND_MESSAGES_LEASING', False):
+            return to_process[:limit]
+
+        pks = to_process.lease(limit, getattr(settings, 'SEND_MESSAGES_LEASE_SECONDS', 300))
+
+        # other senders must see our lease straight away, not once this whole pass is done
+        transaction.commit(using=self.db_key)
+        return Message.objects.using(self.db_key).filter(pk__in=pks).order_by(*to_process.query.order_by)
+
+    def group_by_backend_and_text(self, to_send):
+        """
+        Groups the passed in messages by backend and text, keeping the order in which each
+        group first appears.  Every group can then be sent as a single chunk.
+        """
+        groups = SortedDict()
+        for msg in to_send:
+            groups.setdefault((msg.connection.backend.name, msg.text), []).append(msg)
+        return groups.values()
+
     def send_individual(self, router_url, priority=1):
-        to_process = Message.objects.using(self.db_key).exclude(Q(text="") | Q(text=None) | Q(text=" ")).filter(
-            direction='O',
-            status__in=['Q'], batch=None).order_by('priority', 'status', 'connection__backend__name',
-                                                   'id')  # Order by ID so that they are FIFO in absence of any other priority
-        if len(to_process):
-            self.debug("found [%d] individual messages to proccess, sending the first one..." % len(to_process))
-            self.send_all(router_url, [to_process[0]], priority)
-        else:
-            self.debug("found no individual messages to process")
+        """
+        Drains the messages without a batch a page at a time, sending messages which share
+        a backend and text together.  We stop once the queue is empty, a page didn't let us
+        send anything or we have spent INDIVIDUAL_MESSAGES_TIME_BUDGET seconds.
+        """
+        page_size = getattr(settings, 'INDIVIDUAL_MESSAGES_PAGE_SIZE', 100)
+        time_budget = getattr(settings, 'INDIVIDUAL_MESSAGES_TIME_BUDGET', 5)
+        started = time.time()
+
+        while True:
+            to_process = Message.objects.using(self.db_key).exclude(Q(text="") | Q(text=None) | Q(text=" ")).filter(
+                direction='O',
+                status__in=['Q'], batch=None).order_by('priority', 'status', 'connection__backend__name',
+                                                       'id')  # Order by ID so that they are FIFO in absence of any other priority
+            page = list(self.claim(to_process, page_size).select_related('connection__backend'))
+            if not page:
+                self.debug("found no individual messages to process")
+                return
+
+            self.debug("found [%d] individual messages to process" % len(page))
+            progress_before_page = self.made_progress
+            self.made_progress = False
+            self.send_groups(router_url, self.group_by_backend_and_text(page), priority)
+            transaction.commit(using=self.db_key)
+
+            page_made_progress = self.made_progress
+            self.made_progress = progress_before_page or page_made_progress
+            if len(page) < page_size or not page_made_progress or time.time() - started > time_budget:
+                return
 
     def get_messages_with_invalid_identities(self, backend_name, batch):
         identity_validation_regex = self.get_identity_validation_regex(backend_name)
@@ -178,48 +332,137 @@ class Command(BaseCommand, LoggerMixin):
                 invalid_identity_msgs = self.get_messages_with_invalid_identities(backend_name, batch)
 
                 if invalid_identity_msgs is not None:
-                    invalid_identity_msgs.update(status='C')
+                    self.update_status(invalid_identity_msgs, 'C')
+
+    def is_batch_complete(self, batch, db_key):
+        """
+        Returns whether all of the batch's messages were either sent or cancelled.
+        """
+        if batch.is_tracked:
+            return batch.queued <= 0 and not batch.errored
+
+        return batch.messages.using(db_key).filter(status__in=['S', 'D', 'C']).count() == batch.messages.using(
+            db_key).count()
+
+    def finish_batch(self, batch, db_key):
+        """
+        Marks the passed in batch as sent, or cancelled if some of its messages could not be
+        sent, once none of its messages are pending, queued or leased any more.  Returns
+        whether it was.
+        """
+        if batch.messages.using(db_key).filter(status__in=MessageBatch.IN_FLIGHT_STATUSES).exists():
+            return False
+
+        if batch.is_tracked:
+            # messages whose status was changed outside of send_messages were never counted
+            batch.recount(using=db_key)
+
+        status = 'S' if self.is_batch_complete(batch, db_key) else 'C'
+        if MessageBatch.objects.using(db_key).filter(pk=batch.pk, status='Q').update(status=status):
+            batch.status = status
+            self.info("No more messages in MessageBatch [%d] status set to '%s'" % (batch.pk, status))
+        return True
+
+    def process_batch(self, batch, CHUNK_SIZE, db_key, router_url):
+        """
+        Sends the next chunk of the passed in batch's queued messages, returning whether
+        there was anything to send.
+        """
+        self.batch_id = batch.pk
+        try:
+            self.filter_invalid_connection_identities(batch)
+        finally:
+            self.batch_id = None
+
+        to_process = self.claim(batch.messages.using(db_key).filter(direction='O',
+                                                                    status__in=['Q']).order_by('priority', 'status',
+                                                                                               'connection__backend__name'),
+                                CHUNK_SIZE)
+
+        self.info("chunk of [%d] messages found in db [%s]" % (to_process.count(), db_key))
+        if not to_process.exists():
+            if not self.finish_batch(batch, db_key):
+                # pending, or leased by another sender which will finish it
+                self.debug("MessageBatch [%d] has no messages we can send yet" % batch.pk)
+            return False
+
+        self.debug("found message batch [pk=%d] [name=%s] with Queued messages to send" % (batch.pk, batch.name))
+        self.batch_id = batch.pk
+        try:
+            self.send_all(router_url, to_process, batch.priority)
+        finally:
+            self.batch_id = None
+        return True
 
     def process_messages_for_db(self, CHUNK_SIZE, db_key, router_url):
         self.db_key = db_key
         self.debug("looking for MessageBatch's to process with db [%s]" % str(db_key))
-        blocking_batch = MessageBatch.objects.exclude(messages__status='Q').filter(status='Q')
-        if blocking_batch.exists():
-            self.info("Clearing %d blocking batches" % blocking_batch.count())
-            blocking_batch.update(status='C')
+
+        # batches with nothing left in flight would otherwise block the others, whatever their counters say
+        for batch in MessageBatch.objects.using(db_key).filter(status='Q').exclude(
+                messages__status__in=MessageBatch.IN_FLIGHT_STATUSES):
+            self.finish_batch(batch, db_key)
 
         to_process = MessageBatch.objects.using(db_key).filter(status='Q').order_by('-priority')
 
         if to_process.exists():
             self.info("found [%d] batches with status [Q] in db [%s] to process" % (to_process.count(), db_key))
-            try:
-                batch = to_process[0]
-            except IndexError:
-                pass
-            else:
-                self.filter_invalid_connection_identities(batch)
-
-                priority = batch.priority
-                to_process = batch.messages.using(db_key).filter(direction='O',
-                                                                 status__in=['Q']).order_by('priority', 'status',
-                                                                                            'connection__backend__name')[
-                             :CHUNK_SIZE]
-
-                self.info("chunk of [%d] messages found in db [%s]" % (to_process.count(), db_key))
-                if to_process.exists():
-                    self.debug(
-                        "found message batch [pk=%d] [name=%s] with Queued messages to send" % (batch.pk, batch.name))
-                    self.send_all(router_url, to_process, priority)
-                elif batch.messages.using(db_key).filter(status__in=['S', 'C']).count() == batch.messages.using(
-                        db_key).count():
-                    batch.status = 'S'
-                    batch.save()
-                    self.info("No more messages in MessageBatch [%d] status set to 'S'" % batch.pk)
+
+            # batches whose messages are all pending or leased by other senders are skipped
+            for batch in to_process:
+                if self.process_batch(batch, CHUNK_SIZE, db_key, router_url):
+                    break
 
         self.debug("Looking to see if there are any messages without a batch to send")
         self.send_individual(router_url)
         transaction.commit(using=db_key)
 
+    def process_db(self, db_key, CHUNK_SIZE, recipients):
+        """
+        Runs a single sending pass over the passed in database, rolling back and
+        mailing the admins if anything goes wrong.
+        """
+        try:
+            router_url = settings.DATABASES[db_key]['ROUTER_URL']
+
+            transaction.enter_transaction_management(using=db_key)
+
+            self.process_messages_for_db(CHUNK_SIZE, db_key, router_url)
+
+        except Exception, exc:
+            print exc
+            transaction.rollback(using=db_key)
+            self.critical(traceback.format_exc(exc))
+            if recipients:
+                send_mail('[Django] Error: messenger command', str(traceback.format_exc(exc)),
+                          'root@uganda.rapidsms.org', recipients, fail_silently=True)
+
+    def wait(self, listener, poll_interval):
+        # yield from the messages table, messenger can cause
+        # deadlocks if it's contanstly polling the messages table
+        close_connection()
+        if listener is None:
+            time.sleep(0.5)
+        elif not self.made_progress:
+            # nothing left that we could send, wait until something new is queued
+            listener.wait(poll_interval)
+
+    def run_db_worker(self, db_key, CHUNK_SIZE, recipients):
+        """
+        Sends messages for a single database forever, used as the body of each worker
+        thread when sending concurrently.
+        """
+        # LISTEN connections are per database, but the local UDP fallback can only be bound once
+        listener = None
+        if notify_enabled() and is_postgresql(db_key):
+            listener = OutboxListener([db_key])
+        poll_interval = getattr(settings, 'ROUTER_NOTIFY_POLL_INTERVAL', 5)
+
+        while (True):
+            self.made_progress = False
+            self.process_db(db_key, CHUNK_SIZE, recipients)
+            self.wait(listener, poll_interval)
+
     def handle(self, **options):
         """
 
@@ -236,29 +479,42 @@ class Command(BaseCommand, LoggerMixin):
         if recipients:
             recipients = [email for name, email in recipients]
 
+        if options.get('concurrent') or getattr(settings, 'SEND_MESSAGES_CONCURRENT', False):
+            self.run_concurrently(DB_KEYS, CHUNK_SIZE, recipients)
+            return
+
+        # if enabled, we block waiting for new messages to be queued instead of polling
+        listener = OutboxListener(DB_KEYS) if notify_enabled() else None
+        poll_interval = getattr(settings, 'ROUTER_NOTIFY_POLL_INTERVAL', 5)
+
         while (True):
             self.debug("send_messages started.")
+            self.made_progress = False
             for db_key in DB_KEYS:
-                try:
-                    router_url = settings.DATABASES[db_key]['ROUTER_URL']
+                self.process_db(db_key, CHUNK_SIZE, recipients)
 
-                    transaction.enter_transaction_management(using=db_key)
+            self.wait(listener, poll_interval)
 
-                    self.process_messages_for_db(CHUNK_SIZE, db_key, router_url)
-
-                except Exception, exc:
-                    print exc
-                    transaction.rollback(using=db_key)
-                    self.critical(traceback.format_exc(exc))
-                    if recipients:
-                        send_mail('[Django] Error: messenger command', str(traceback.format_exc(exc)),
-                                  'root@uganda.rapidsms.org', recipients, fail_silently=True)
-                    continue
-
-            # yield from the messages table, messenger can cause
-            # deadlocks if it's contanstly polling the messages table
-            close_connection()
-            time.sleep(0.5)
+    def run_concurrently(self, DB_KEYS, CHUNK_SIZE, recipients):
+        """
+        Starts one worker thread per database so that a slow database or router url
+        only holds up its own messages.  Every worker gets its own copy of this command,
+        as we keep per database state on it, and Django gives each thread its own
+        database connections.
+        """
+        workers = []
+        for db_key in DB_KEYS:
+            worker = threading.Thread(target=copy.copy(self).run_db_worker, args=(db_key, CHUNK_SIZE, recipients),
+                                      name="send_messages-%s" % db_key)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+            self.info("started sending worker for db [%s]" % db_key)
+
+        # our workers never finish, but joining with a timeout keeps us responsive to Ctrl-C
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)
 
     def get_backend_class(self, backend_config, backend_name):
         path = backend_config["ENGINE"]
@@ -271,7 +527,7 @@ class Command(BaseCommand, LoggerMixin):
 
     def build_send_url_from_backend(self, backend_name, backend_config, text, identities):
 
-        backend = self.get_backend_class(backend_config, backend_name)
+        backend = backend_registry.get(backend_name, backend_config, self.get_backend_class)
 
         context = getattr(backend_config, 'context', {})
 
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from rapidsms_httprouter.management.commands.send_messages import Command as SendMessagesCommand
+
+
+class Command(SendMessagesCommand):
+    help = """sends messages from all project DBs, keeping many requests to the router urls in flight at once
+    """
+
+    # fetch_url reads the backend being sent from self, which differs per worker thread here
+    _local = threading.local()
+
+    @property
+    def backend_name(self):
+        return getattr(self._local, 'backend_name', None)
+
+    @backend_name.setter
+    def backend_name(self, value):
+        self._local.backend_name = value
+
+    def get_pool(self):
+        if getattr(self, 'pool', None) is None:
+            self.pool = ThreadPool(getattr(settings, 'ASYNC_SEND_WORKERS', 20))
+            self.semaphores = {}
+            self.semaphores_lock = threading.Lock()
+        return self.pool
+
+    def get_backend_semaphore(self, backend_name):
+        """
+        Returns the semaphore limiting how many requests may be in flight for the passed
+        in backend, configured through ASYNC_SEND_CONCURRENCY, ie:
+
+            ASYNC_SEND_CONCURRENCY = {'default': 4, 'aggregator': 10}
+        """
+        with self.semaphores_lock:
+            if backend_name not in self.semaphores:
+                limits = getattr(settings, 'ASYNC_SEND_CONCURRENCY', {})
+                limit = limits.get(backend_name, limits.get('default', 4))
+                self.semaphores[backend_name] = threading.BoundedSemaphore(limit)
+            return self.semaphores[backend_name]
+
+    def split_chunk(self, pks):
+        """
+        Splits a chunk into several requests of at most ASYNC_SEND_RECIPIENTS_PER_REQUEST
+        recipients each (100 by default), so that large chunks are sent concurrently too.
+        Set it to None to send every chunk in a single request.
+        """
+        size = getattr(settings, 'ASYNC_SEND_RECIPIENTS_PER_REQUEST', 100)
+        if not size:
+            return [pks]
+        return [pks[i:i + size] for i in range(0, len(pks), size)]
+
+    def fetch_chunk(self, backend_name, url, cost):
+        with self.get_backend_semaphore(backend_name):
+            self.throttle(backend_name, cost)
+            self.backend_name = backend_name
+            return self.fetch_url(url)
+
+    def submit_all(self, router_url, to_send, priority):
+        """
+        Starts sending every chunk of the passed in messages on the pool, returning the
+        requests in flight.  Only the HTTP requests happen on the worker threads, all
+        database work stays on our thread and within its transaction.
+        """
+        pool = self.get_pool()
+
+        in_flight = []
+        for backend_name, backend_pks in self.group_by_backend(to_send):
+            for pks in self.split_chunk(backend_pks):
+                msgs = self.get_chunk_messages(pks, backend_name)
+                if msgs is None:
+                    continue
+
+                try:
+                    url = self.build_chunk_url(router_url, msgs, backend_name, priority)
+                except Exception as e:
+                    self.error("SMS%s Message not sent: %s .. queued for later delivery." % (pks, str(e)))
+                    msgs.update(status='Q')
+                    continue
+
+                in_flight.append((msgs, pks, pool.apply_async(self.fetch_chunk, (backend_name, url, len(pks)))))
+
+        return in_flight
+
+    def collect(self, in_flight):
+        """
+        Waits for the passed in requests and updates the status of their messages, with
+        the same semantics as send_backend_chunk.
+        """
+        for msgs, pks, result in in_flight:
+            try:
+                self.update_chunk_status(msgs, pks, result.get())
+            except Exception as e:
+                self.error("SMS%s Message not sent: %s .. queued for later delivery." % (pks, str(e)))
+                msgs.update(status='Q')
+
+    def send_all(self, router_url, to_send, priority):
+        """
+        Sends every chunk of the passed in messages concurrently.
+        """
+        self.collect(self.submit_all(router_url, to_send, priority))
+
+    def send_groups(self, router_url, groups, priority):
+        """
+        Sends the groups of a page of individual messages concurrently, every group is
+        submitted before we wait for any of them.
+        """
+        in_flight = []
+        for to_send in groups:
+            in_flight.extend(self.submit_all(router_url, to_send, priority))
+        self.collect(in_flight)
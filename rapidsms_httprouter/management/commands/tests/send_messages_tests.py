@@ -51,20 +51,36 @@ class SendMessagesTest(TestCase):
 
         self.assertEqual(len(self.send_messages_command.invocations), 0)
 
-    def test_should_send_messages_one_at_a_time_if_there_is_no_batch(self):
+    def test_should_send_messages_without_a_batch_and_the_same_text_together(self):
         self.create_queued_outgoing_message(None, self.connection_1)
         self.create_queued_outgoing_message(None, self.connection_2)
 
         self.send_messages_command.process_messages_for_db(10, self.db_key, "http://whocares.com?text=%(text)s&to=%(recipient)s")
 
         self.assertEqual(len(self.send_messages_command.invocations), 1)
-        self.assertEqual(self.send_messages_command.invocations[0], "http://whocares.com?text=Hello+from+the+SendMessagesTest&to=990000")
+        self.assertEqual(self.send_messages_command.invocations[0], "http://whocares.com?text=Hello+from+the+SendMessagesTest&to=990000+990001")
+
+    def test_should_send_messages_without_a_batch_and_different_texts_separately(self):
+        self.create_queued_outgoing_message(None, self.connection_1, text="first")
+        self.create_queued_outgoing_message(None, self.connection_2, text="second")
 
-        self.send_messages_command.reset_invocations()
         self.send_messages_command.process_messages_for_db(10, self.db_key, "http://whocares.com?text=%(text)s&to=%(recipient)s")
 
-        self.assertEqual(len(self.send_messages_command.invocations), 1)
-        self.assertEqual(self.send_messages_command.invocations[0], "http://whocares.com?text=Hello+from+the+SendMessagesTest&to=990001")
+        self.assertEqual(self.send_messages_command.invocations,
+                         ["http://whocares.com?text=first&to=990000", "http://whocares.com?text=second&to=990001"])
+
+    def test_should_drain_messages_without_a_batch_a_page_at_a_time(self):
+        settings.INDIVIDUAL_MESSAGES_PAGE_SIZE = 1
+        try:
+            self.create_queued_outgoing_message(None, self.connection_1, text="first")
+            self.create_queued_outgoing_message(None, self.connection_2, text="second")
+
+            self.send_messages_command.process_messages_for_db(10, self.db_key, "http://whocares.com?text=%(text)s&to=%(recipient)s")
+        finally:
+            settings.INDIVIDUAL_MESSAGES_PAGE_SIZE = 100
+
+        self.assertEqual(len(self.send_messages_command.invocations), 2)
+        self.assertEqual(0, Message.objects.filter(status='Q').count())
 
 
     def create_queued_outgoing_message(self, message_batch, connection, text="Hello from the SendMessagesTest"):
@@ -1,6 +1,7 @@
 # This Python file uses the following encoding: utf-8
 import os, sys
 import datetime
+import operator
 from tempfile import mkstemp
 from django.conf import settings
 from django.db import models, connection, connections
@@ -8,19 +9,128 @@ from django.db.models import signals
 from django.db.models.fields import AutoField, DateTimeField, DateField, TimeField, FieldDoesNotExist
 from django.db.models.fields.related import ForeignKey, OneToOneField, ManyToManyField
 from django.db.models.query import QuerySet
+from .bulk_copy import copy_enabled, copy_rows, reserve_ids
+from .databases import is_postgresql, is_sqlite
 
 class ForUpdateQuerySet(QuerySet):
     def for_single_update(self):
-        if 'sqlite' in connections[self.db].settings_dict['ENGINE'].lower():
+        if is_sqlite(self.db):
             # Noop on SQLite since it doesn't support FOR UPDATE
             return self
         sql, params = self.query.get_compiler(self.db).as_sql()
         return self.model._default_manager.raw(sql.rstrip() + ' LIMIT 1 FOR UPDATE', params)
 
+    def is_postgres(self):
+        return is_postgresql(self.db)
+
+    def with_text(self, text):
+        """
+        Filters to the messages with exactly the passed in text.  On PostgreSQL the text
+        itself isn't indexed, so we also match on its md5 which is.
+        """
+        queryset = self.filter(text=text)
+        if self.is_postgres():
+            column = '%s.text' % self.model._meta.db_table
+            queryset = queryset.extra(where=['md5(%s) = md5(%%s)' % column], params=[text])
+        return queryset
+
+    def text_search(self, term, field='text'):
+        """
+        Returns the Q matching messages whose text (or that of the message at the end of
+        the passed in relation, ie in_response_to__text) contains the passed in term.
+
+        With ROUTER_TRIGRAM_SEARCH on PostgreSQL this is done with an ILIKE subquery,
+        which unlike icontains can use the trigram index on the text.
+        """
+        if not (getattr(settings, 'ROUTER_TRIGRAM_SEARCH', False) and self.is_postgres()):
+            return models.Q(**{'%s__icontains' % field: term})
+
+        pattern = '%%%s%%' % term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        matching = self.model._default_manager.using(self.db).extra(where=['text ILIKE %s'], params=[pattern])
+        lookup = 'pk__in' if field == 'text' else '%sin' % field[:-len('text')]
+        return models.Q(**{lookup: matching.values('pk')})
+
+    def search(self, terms, fields=('text', 'in_response_to__text', 'connection__identity')):
+        """
+        Filters to the messages matching every one of the passed in terms in at least
+        one of the passed in fields, like the console and admin searches.
+        """
+        queryset = self
+        for term in terms:
+            queries = [self.text_search(term, field) if field.endswith('text')
+                       else models.Q(**{'%s__icontains' % field: term}) for field in fields]
+            queryset = queryset.filter(reduce(operator.or_, queries))
+        return queryset
+
+    def for_receipt_token(self, token, identity):
+        """
+        Filters to the message a delivery receipt is for, from the token built by
+        Message.receipt_token and the normalized identity the receipt was sent to.  Raises
+        a ValueError for invalid tokens.
+        """
+        chunk = int(token)
+
+        # messages sent on their own before receipt_chunk existed are matched on their id
+        pks = self.filter(models.Q(receipt_chunk=chunk) | models.Q(pk=chunk),
+                          connection__identity=identity, status='S').values_list('pk', flat=True)
+        return self.filter(pk__in=list(pks))
+
+    def reclaim_expired_leases(self):
+        """
+        Puts messages whose lease ran out, ie because their sender died, back in the queue.
+        """
+        return self.model._default_manager.using(self.db).filter(status='L',
+                                                                 lease_expires__lt=datetime.datetime.now()) \
+            .update(status='Q', lease_expires=None)
+
+    def lease(self, limit, seconds=300):
+        """
+        Atomically moves up to limit of the queued ('Q') messages in this queryset to the
+        locked ('L') status, with a lease expiring after the passed in number of seconds,
+        and returns their ids.  Several senders can lease from the same queue without ever
+        being handed the same message.
+
+        On PostgreSQL rows locked by another sender are skipped using FOR UPDATE SKIP
+        LOCKED, elsewhere each message is claimed with an UPDATE guarded on its status.
+        """
+        self.reclaim_expired_leases()
+
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        candidates = self.filter(status='Q')
+        table = self.model._meta.db_table
+
+        if self.is_postgres():
+            sql, params = candidates.values('id').query.get_compiler(self.db).as_sql()
+            cursor = connections[self.db].cursor()
+            cursor.execute("UPDATE %s SET status = 'L', lease_expires = %%s WHERE id IN (%s LIMIT %d FOR UPDATE OF %s SKIP LOCKED) RETURNING id" %
+                           (table, sql.rstrip(), int(limit), table), [expires] + list(params))
+            return [row[0] for row in cursor.fetchall()]
+
+        leased = []
+        for pk in candidates.values_list('id', flat=True)[:limit]:
+            if self.model._default_manager.using(self.db).filter(pk=pk, status='Q').update(status='L', lease_expires=expires):
+                leased.append(pk)
+        return leased
+
 class ForUpdateManager(models.Manager):
     def get_query_set(self):
         return ForUpdateQuerySet(self.model, using=self._db)
 
+    def lease(self, limit, seconds=300):
+        return self.get_query_set().lease(limit, seconds)
+
+    def with_text(self, text):
+        return self.get_query_set().with_text(text)
+
+    def search(self, terms, **kwargs):
+        return self.get_query_set().search(terms, **kwargs)
+
+    def reclaim_expired_leases(self):
+        return self.get_query_set().reclaim_expired_leases()
+
+    def for_receipt_token(self, token, identity):
+        return self.get_query_set().for_receipt_token(token, identity)
+
 def hash_dict(dictionary):
     return hash(frozenset(dictionary.items()))
 
@@ -957,10 +1067,16 @@ class BulkInsertManager(models.Manager):
         """
         Bulk insert using INSERT
         ***Limited by max packet size on mysql server***
+
+        On PostgreSQL the rows are loaded with COPY instead, see copy_insert.
         """
         qn = connection.ops.quote_name
         cursor = connection.cursor()
 
+        # PostgreSQL has no INSERT IGNORE, only explicitly clobbering inserts keep using INSERT there
+        if not autoclobber and copy_enabled():
+            return self.copy_insert(cursor, table, fields, queue, order)
+
         if autoclobber is None or autoclobber == True:
             autoclobber = ''
         else:
@@ -981,3 +1097,17 @@ class BulkInsertManager(models.Manager):
         cursor.execute(sql, value_list)
         return cursor.fetchall()
 
+    def copy_insert(self, cursor, table, fields, queue, order):
+        """
+        Bulk insert using COPY, the ids are taken out of the table's sequence first so
+        that we can return them in the same order as INSERT ... RETURNING does.
+        """
+        ids = reserve_ids(cursor, table, len(order))
+
+        rows = []
+        for pk, (key, _) in zip(ids, order):
+            kwargs = queue[key]
+            rows.append([pk] + [kwargs[f.name] for f in fields])
+
+        copy_rows(cursor, table, ['id'] + [f.column for f in fields], rows)
+        return [(pk,) for pk in ids]
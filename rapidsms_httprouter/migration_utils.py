@@ -0,0 +1,28 @@
+"""
+Helpers shared by our South migrations.
+"""
+from django.db import connections
+
+
+def execute_in_autocommit(db, statements):
+    """
+    Runs the passed in statements outside of any transaction of the passed in South
+    database, ie for CREATE INDEX CONCURRENTLY.  psycopg2 opens a new transaction
+    before the next statement even after a commit, so the connection has to be
+    switched to autocommit for them.
+    """
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+    db.commit_transaction()
+    connection = connections[db.db_alias]
+    connection.cursor()
+    raw_connection = connection.connection
+    isolation_level = raw_connection.isolation_level
+    raw_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    try:
+        cursor = raw_connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+    finally:
+        raw_connection.set_isolation_level(isolation_level)
+        db.start_transaction()
@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+from django.conf import settings
 from django.db import models, transaction
 import django.dispatch
 from django.db import connection as db_connection
+from django.db.models.query import QuerySet
 from rapidsms.models import Connection
 from .managers import ForUpdateManager
+from .bulk_copy import copy_enabled, copy_rows
+from .databases import is_postgresql
+from .notify import notify_outbox
 import logging
 
 log = logging.getLogger(__name__)
 
-mass_text_sent = django.dispatch.Signal(providing_args=["messages", "status"])
+mass_text_sent = django.dispatch.Signal(providing_args=["messages", "batch_messages", "status", "batch_id", "count"])
 
 DIRECTION_CHOICES = (
     ("I", "Incoming"),
@@ -45,10 +50,70 @@ class MessageBatch(models.Model):
     name = models.CharField(max_length=15, null=True, blank=True)
     priority = models.IntegerField(default=1)
 
+    # counts of the batch's messages still to be sent and of those which have been sent,
+    # cancelled or errored.  These are only kept for batches created by Message.mass_text,
+    # they are None for any other batch.
+    queued = models.IntegerField(null=True, blank=True)
+    sent = models.IntegerField(null=True, blank=True)
+    cancelled = models.IntegerField(null=True, blank=True)
+    errored = models.IntegerField(null=True, blank=True)
+
+    # which counter messages moving to each status count towards
+    STATUS_COUNTERS = {
+        'S': 'sent',
+        'C': 'cancelled',
+        'B': 'errored',
+        'E': 'errored',
+        'K': 'errored',
+    }
+
+    # statuses of messages which may still be sent, they count as queued
+    IN_FLIGHT_STATUSES = ('P', 'L', 'Q')
+
+    @property
+    def is_tracked(self):
+        return self.queued is not None
+
+    @classmethod
+    def count_transition(cls, batch_id, status, count, using='default'):
+        """
+        Moves count queued messages of the passed in batch to the counter for status,
+        this is a no-op for batches whose counts aren't tracked.
+        """
+        counter = cls.STATUS_COUNTERS.get(status)
+        if batch_id is None or not counter or not count:
+            return
+
+        cls.objects.using(using).filter(pk=batch_id, queued__isnull=False) \
+            .update(**{'queued': models.F('queued') - count, counter: models.F(counter) + count})
+
+    def recount(self, using='default'):
+        """
+        Rebuilds the counters from the batch's messages.  The counters only follow the
+        messages sent by send_messages, so they fall behind when messages are cancelled
+        by apps or in the admin, or never get queued at all.
+        """
+        counts = dict(queued=0, sent=0, cancelled=0, errored=0)
+        statuses = self.messages.using(using).values('status').annotate(count=models.Count('id'))
+        for row in statuses:
+            if row['status'] in self.IN_FLIGHT_STATUSES:
+                counts['queued'] += row['count']
+            elif row['status'] == 'D':
+                counts['sent'] += row['count']
+            elif row['status'] in self.STATUS_COUNTERS:
+                counts[self.STATUS_COUNTERS[row['status']]] += row['count']
+
+        for counter, count in counts.items():
+            setattr(self, counter, count)
+        MessageBatch.objects.using(using).filter(pk=self.pk).update(**counts)
+
+
+OUTGOING_COLUMNS = ('text', 'date', 'direction', 'status', 'batch_id', 'connection_id', 'priority')
+
 
 class Message(models.Model):
     connection = models.ForeignKey(Connection, related_name='messages')
-    text = models.TextField(db_index=True)
+    text = models.TextField()
     direction = models.CharField(max_length=1, choices=DIRECTION_CHOICES, db_index=True)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, db_index=True)
     date = models.DateTimeField(auto_now_add=True)
@@ -58,6 +123,10 @@ class Message(models.Model):
     application = models.CharField(max_length=100, null=True)
 
     batch = models.ForeignKey(MessageBatch, related_name='messages', null=True)
+    # when a message in the 'L' status should be put back in the queue
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # the chunk the message was last sent in, identifies it in delivery receipts along with its receiver
+    receipt_chunk = models.IntegerField(null=True, blank=True)
     # set our manager to our update manager
     objects = ForUpdateManager()
 
@@ -77,6 +146,15 @@ class Message(models.Model):
                     direction=self.direction, status=self.status, text=self.text,
                     date=self.date.isoformat())
 
+    @classmethod
+    def receipt_token(cls, pks):
+        """
+        Returns the token identifying a chunk of messages in delivery receipts, the lowest
+        of their ids, so that the token of a single message is its id.  It must be stored
+        as the receipt_chunk of every message of the chunk.
+        """
+        return min(pks)
+
     @classmethod
     @transaction.commit_on_success
     def mass_text(cls, text, connections, status='P', batch_status='Q', batch_name=None):
@@ -86,25 +164,149 @@ class Message(models.Model):
             # log.info(
             #     "[mass_text] Sending message to [%d] connections with batch name [%s]" % (len(connections), batch_name))
 
-        batch = MessageBatch.objects.create(status=batch_status, name=batch_name, priority=1)  # Todo fix the damn prioty shit
+        batch = MessageBatch.objects.create(status=batch_status, name=batch_name, priority=1,  # Todo fix the damn prioty shit
+                                            queued=0, sent=0, cancelled=0, errored=0)
+        d = datetime.datetime.now()
+        c = db_connection.cursor()
+
+        toret = []
+        count = cls.insert_outgoing(c, text, d, status, batch.pk, [connection.pk for connection in connections])
+        if count:
+            batch.queued = count
+            MessageBatch.objects.filter(pk=batch.pk).update(queued=batch.queued)
+            toret = Message.objects.filter(batch=batch)
+            mass_text_sent.send(sender=batch, messages=toret, batch_messages=BatchMessages(batch.pk, count),
+                                status=status, batch_id=batch.pk, count=count)
+            notify_outbox()
+
+        # log.info("[mass_text] TRANSACTION COMMIT")
+        return toret
+
+    @classmethod
+    def insert_outgoing(cls, cursor, text, date, status, batch_id, connection_ids, priority=10):
+        """
+        Inserts one outgoing message per passed in connection id, returning how many were
+        inserted.  Uses COPY on PostgreSQL, or a single multi-row INSERT if ROUTER_BULK_COPY
+        is turned off.
+        """
         sql = 'insert into rapidsms_httprouter_message (text, date, direction, status, batch_id, connection_id, priority) values '
-        insert_list = []
-        params_list = []
+        rows = [(text, date, 'O', status, batch_id, connection_id, priority) for connection_id in connection_ids]
+
+        if not rows:
+            return 0
+
+        if copy_enabled():
+            return copy_rows(cursor, cls._meta.db_table, OUTGOING_COLUMNS, rows)
+        elif is_postgresql():
+            params_list = []
+            for row in rows:
+                params_list += row
+            cursor.execute(sql + ",".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(rows)), params_list)
+        else:
+            cursor.executemany(sql + "(%s, %s, %s, %s, %s, %s, %s)", rows)
+
+        return len(rows)
+
+    @classmethod
+    @transaction.commit_on_success
+    def mass_text_stream(cls, text, connections, status='P', batch_status='Q', batch_name=None, chunk_size=None):
+        """
+        Like mass_text, but for very large numbers of recipients.  Takes any iterable of
+        connection ids (or connections), or a queryset of connections, and inserts the
+        messages MASS_TEXT_CHUNK_SIZE at a time without ever loading Connection instances.
+
+        Returns the batch and the number of messages created.
+        """
+        if isinstance(connections, QuerySet):
+            connections = connections.values_list('pk', flat=True).iterator()
+
+        chunk_size = chunk_size or getattr(settings, 'MASS_TEXT_CHUNK_SIZE', 1000)
+        batch = MessageBatch.objects.create(status=batch_status, name=batch_name, priority=1,
+                                            queued=0, sent=0, cancelled=0, errored=0)
         d = datetime.datetime.now()
         c = db_connection.cursor()
 
+        count = 0
+        chunk = []
         for connection in connections:
-            insert_list.append("(%s, %s, 'O', %s, %s, %s, %s)")
-            params_list += [text, d, status, batch.pk, connection.pk, 10]
+            chunk.append(getattr(connection, 'pk', connection))
+            if len(chunk) >= chunk_size:
+                count += cls.insert_outgoing(c, text, d, status, batch.pk, chunk)
+                chunk = []
 
-        toret = []
-        if insert_list:
-            sql = "%s %s returning id" % (sql, ",".join(insert_list))
-            c.execute(sql, params_list)
+        if chunk:
+            count += cls.insert_outgoing(c, text, d, status, batch.pk, chunk)
 
-            pks = c.fetchall()
-            toret = Message.objects.filter(pk__in=[pk[0] for pk in pks])
-            mass_text_sent.send(sender=batch, messages=toret, status=status)
+        batch.queued = count
+        MessageBatch.objects.filter(pk=batch.pk).update(queued=count)
 
-        # log.info("[mass_text] TRANSACTION COMMIT")
-        return toret
+        if count:
+            mass_text_sent.send(sender=batch, messages=Message.objects.filter(batch=batch),
+                                batch_messages=BatchMessages(batch.pk, count, chunk_size),
+                                status=status, batch_id=batch.pk, count=count)
+            notify_outbox()
+
+        return batch, count
+
+
+class BatchMessages(object):
+    """
+    The messages of a mass text, as passed to mass_text_sent receivers in batch_messages
+    next to the plain queryset in messages.  Nothing is loaded until it is used,
+    iterating loads the messages chunk_size at a time, and len(), count() and truth
+    testing don't query at all.
+    """
+
+    def __init__(self, batch_id, count, chunk_size=None):
+        self.batch_id = batch_id
+        self.total = count
+        self.chunk_size = chunk_size or getattr(settings, 'MASS_TEXT_CHUNK_SIZE', 1000)
+        self._id_range = None
+
+    @property
+    def queryset(self):
+        return Message.objects.filter(batch__pk=self.batch_id)
+
+    def __len__(self):
+        return self.total
+
+    def __nonzero__(self):
+        return self.total > 0
+
+    def count(self):
+        return self.total
+
+    def id_range(self):
+        """
+        Returns the lowest and highest ids of the batch's messages.  Other messages may
+        have been created in between.
+        """
+        if self._id_range is None:
+            ids = self.queryset.aggregate(min_id=models.Min('pk'), max_id=models.Max('pk'))
+            self._id_range = (ids['min_id'], ids['max_id'])
+        return self._id_range
+
+    def chunks(self, queryset=None):
+        """
+        Yields lists of at most chunk_size of the passed in queryset's rows, walking
+        the batch in id order.
+        """
+        queryset = self.queryset if queryset is None else queryset
+        last_id = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_id).order_by('pk')[:self.chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last = chunk[-1]
+            last_id = last if isinstance(last, (int, long)) else last.pk
+
+    def iter_ids(self):
+        for chunk in self.chunks(self.queryset.values_list('pk', flat=True)):
+            for pk in chunk:
+                yield pk
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for message in chunk:
+                yield message
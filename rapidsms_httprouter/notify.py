@@ -0,0 +1,125 @@
+"""
+Lets processes queueing outgoing messages wake up a waiting send_messages command
+instead of it having to poll the database.
+
+On PostgreSQL this uses LISTEN/NOTIFY, so notifications are only delivered once the
+transaction which queued the messages commits.  Other databases fall back to a UDP
+datagram on the loopback interface, which only works when the sender runs on the same
+host.
+
+Enable it with ROUTER_NOTIFY_OUTBOX = True.
+"""
+import select
+import socket
+
+from django.conf import settings
+from django.db import connections, transaction
+from rapidsms.log.mixin import LoggerMixin
+
+from .databases import is_postgresql
+
+
+def notify_enabled():
+    return getattr(settings, 'ROUTER_NOTIFY_OUTBOX', False)
+
+
+def get_channel():
+    return getattr(settings, 'ROUTER_NOTIFY_CHANNEL', 'httprouter_outbox')
+
+
+def get_local_address():
+    return ('127.0.0.1', getattr(settings, 'ROUTER_NOTIFY_PORT', 13031))
+
+
+def notify_outbox(using='default'):
+    """
+    Signals any listening senders that there are new messages in the outbox of
+    the passed in database.
+    """
+    if not notify_enabled():
+        return
+
+    if is_postgresql(using):
+        connections[using].cursor().execute('NOTIFY %s' % get_channel())
+
+        # the notification is only sent once committed, callers which already committed
+        # their messages would otherwise leave it in a transaction nobody commits
+        transaction.commit_unless_managed(using=using)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(using, get_local_address())
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+
+class OutboxListener(object, LoggerMixin):
+    """
+    Waits for outbox notifications on the passed in databases.  Uses its own
+    connections so that the LISTEN survives the sender closing its Django connections.
+    """
+
+    def __init__(self, db_keys):
+        self.pg_connections = []
+        self.socket = None
+
+        for db_key in db_keys:
+            if is_postgresql(db_key):
+                self.pg_connections.append(self.listen(connections[db_key].settings_dict))
+            elif self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.socket.bind(get_local_address())
+                self.socket.setblocking(0)
+
+    def listen(self, settings_dict):
+        import psycopg2
+        import psycopg2.extensions
+
+        params = dict(database=settings_dict['NAME'])
+        for key, param in (('USER', 'user'), ('PASSWORD', 'password'), ('HOST', 'host'), ('PORT', 'port')):
+            if settings_dict.get(key):
+                params[param] = settings_dict[key]
+
+        conn = psycopg2.connect(**params)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute('LISTEN %s' % get_channel())
+        return conn
+
+    def wait(self, timeout):
+        """
+        Blocks until we are notified or timeout seconds pass.  Returns whether we
+        were notified.
+        """
+        readers = list(self.pg_connections)
+        if self.socket is not None:
+            readers.append(self.socket)
+
+        if not readers:
+            return False
+
+        ready, _, _ = select.select(readers, [], [], timeout)
+        notified = False
+        for reader in ready:
+            if reader is self.socket:
+                # drain everything that piled up while we were busy sending
+                try:
+                    while True:
+                        self.socket.recv(1024)
+                        notified = True
+                except socket.error:
+                    pass
+            else:
+                reader.poll()
+                if reader.notifies:
+                    notified = True
+                    del reader.notifies[:]
+
+        return notified
+
+    def close(self):
+        for conn in self.pg_connections:
+            conn.close()
+        if self.socket is not None:
+            self.socket.close()
@@ -43,7 +43,7 @@ def get_alarms(mode="shortcode"):
         for modem in settings.ALLOWED_MODEMS[shortcode.name]:
             (modem_backend, t) = Backend.objects.get_or_create(name=modem)
 
-            ret = Message.objects.filter(date__gt=time_offset, direction='I', text=gen_qos_msg(),
+            ret = Message.objects.with_text(gen_qos_msg()).filter(date__gt=time_offset, direction='I',
                     connection=Connection.objects.get_or_create(identity=settings.SHORTCODE_BACKENDS[shortcode.name], backend=modem_backend)[0])
             if not ret.count():
                 msg = "No response  from %s when using  %s(%s)" % (settings.SHORTCODE_BACKENDS[shortcode.name], modem_backend.name, settings.MODEM_BACKENDS[modem_backend.name])
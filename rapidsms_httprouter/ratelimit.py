@@ -0,0 +1,97 @@
+"""
+Token bucket rate limiting of outgoing sends per backend.
+
+Limits are configured in messages per second along with the burst allowed, ie:
+
+    SEND_RATE_LIMITS = {
+        'default': {'rate': 30, 'burst': 60},
+        'aggregator': {'rate': 100, 'burst': 200},
+    }
+
+The state of every bucket is kept in a file under SEND_RATE_LIMIT_DIR which is locked
+while it is updated, so that all the sender processes on a host share the same limit.
+"""
+import fcntl
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+
+def get_rate_limit(backend_name):
+    limits = getattr(settings, 'SEND_RATE_LIMITS', {})
+    return limits.get(backend_name, limits.get('default'))
+
+
+class TokenBucket(object):
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+    def take(self, cost):
+        """
+        Takes cost tokens out of the bucket if enough are available, returning 0, otherwise
+        returns the number of seconds to wait before trying again.
+
+        Chunks costing more than the whole burst only need a full bucket, the bucket then
+        goes negative so that the sustained rate is still respected.
+        """
+        needed = min(cost, self.burst)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+
+            state = os.read(fd, 64).split()
+            if len(state) == 2:
+                tokens, updated = float(state[0]), float(state[1])
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            else:
+                tokens = self.burst
+
+            if tokens < needed:
+                return (needed - tokens) / self.rate
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, "%f %f" % (tokens - cost, now))
+            return 0
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def acquire(self, cost):
+        """
+        Blocks until cost tokens could be taken out of the bucket.
+        """
+        while True:
+            wait = self.take(cost)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+def get_bucket(backend_name):
+    """
+    Returns the token bucket for the passed in backend, or None if it isn't rate limited.
+    """
+    limit = get_rate_limit(backend_name)
+    if not limit:
+        return None
+
+    directory = getattr(settings, 'SEND_RATE_LIMIT_DIR', tempfile.gettempdir())
+    path = os.path.join(directory, 'httprouter_ratelimit_%s' % backend_name)
+    return TokenBucket(path, limit['rate'], limit.get('burst', limit['rate']))
+
+
+def throttle(backend_name, cost):
+    """
+    Waits until cost messages may be sent through the passed in backend.
+    """
+    bucket = get_bucket(backend_name)
+    if bucket is not None:
+        bucket.acquire(cost)
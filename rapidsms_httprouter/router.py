@@ -1,19 +1,60 @@
 from django.conf import settings
-from django.db import transaction
+from django.db import transaction, close_connection, connections as connections_by_alias
+from django.db.models.signals import post_save, post_delete
 from django.db.utils import DatabaseError
+from .cache import LRUCache
+from .databases import is_postgresql
 from .models import Message
+from .notify import notify_outbox
 from rapidsms.models import Backend, Connection
 from rapidsms.apps.base import AppBase
 from rapidsms.messages.incoming import IncomingMessage
 from rapidsms.messages.outgoing import OutgoingMessage
 from rapidsms.log.mixin import LoggerMixin
-from threading import Lock
+from threading import Lock, Timer
 
+import atexit
+import datetime
 import re
+import traceback
 
 # our worker threads
 outgoing_worker_threads = []
 
+# everything but digits and lowercase letters is stripped out of numbers, bytestrings are
+# normalized with str.translate, unicode strings with the pattern
+NUMBER_PATTERN = re.compile(u'[^0-9a-z]')
+NUMBER_DELETE_CHARS = ''.join(c for c in map(chr, range(256)) if not ('0' <= c <= '9' or 'a' <= c <= 'z'))
+
+# in process caches of backends and connections seen by add_message, these are disabled
+# unless ROUTER_CONNECTION_CACHE_SIZE is set
+backend_cache = LRUCache(getattr(settings, 'ROUTER_CONNECTION_CACHE_SIZE', 0),
+                         getattr(settings, 'ROUTER_CONNECTION_CACHE_TTL', 300))
+connection_cache = LRUCache(getattr(settings, 'ROUTER_CONNECTION_CACHE_SIZE', 0),
+                            getattr(settings, 'ROUTER_CONNECTION_CACHE_TTL', 300))
+
+
+def invalidate_cached_instance(sender, instance, **kwargs):
+    """
+    Drops any cached entries for a Backend or Connection which was just saved or deleted.
+    """
+    if sender is Backend:
+        backend_cache.delete_tag(instance.pk)
+    else:
+        connection_cache.delete_tag(instance.pk)
+
+def clear_cached_instances():
+    """
+    Drops every cached Backend and Connection.  Queryset updates don't send post_save, so
+    anything changing identities or backends with update() must call this afterwards.
+    """
+    backend_cache.clear()
+    connection_cache.clear()
+
+for model in (Backend, Connection):
+    post_save.connect(invalidate_cached_instance, sender=model, dispatch_uid='httprouter_cache_%s' % model.__name__)
+    post_delete.connect(invalidate_cached_instance, sender=model, dispatch_uid='httprouter_cache_%s' % model.__name__)
+
 
 def start_sending_mass_messages():
     "Deprecated"
@@ -25,6 +66,54 @@ def stop_sending_mass_messages():
     pass
 
 
+class IncomingStatusWriter(object, LoggerMixin):
+    """
+    Collects the final status and application of handled incoming messages and writes
+    them out together, with one UPDATE per distinct (status, application) pair, at most
+    `interval` seconds after the first pending message was added.
+
+    Used when ROUTER_STATUS_WRITE_BEHIND is set to 'batch'.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.pending = {}
+        self.lock = Lock()
+        self.timer = None
+
+    def add(self, message_id, status, application=None):
+        if application is not None:
+            application = unicode(application)
+
+        with self.lock:
+            self.pending[message_id] = (status, application)
+            if self.timer is None:
+                self.timer = Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.timer = None
+
+        groups = {}
+        for message_id, values in pending.items():
+            groups.setdefault(values, []).append(message_id)
+
+        try:
+            for (status, application), message_ids in groups.items():
+                Message.objects.filter(pk__in=message_ids).update(status=status, application=application)
+        except Exception, exc:
+            self.error("Unable to write status for SMS%s: %s" % (pending.keys(), traceback.format_exc(exc)))
+        finally:
+            # we are usually called from our timer thread, don't leave its connection open
+            close_connection()
+
+incoming_status_writer = IncomingStatusWriter(getattr(settings, 'ROUTER_STATUS_FLUSH_INTERVAL', 1.0))
+atexit.register(incoming_status_writer.flush)
+
+
 class HttpRouter(object, LoggerMixin):
     """
     This is a simplified version of the normal SMS router in that it has no threading.  Instead
@@ -39,6 +128,12 @@ class HttpRouter(object, LoggerMixin):
         # the apps we'll run through
         self.apps = []
 
+        # per-phase lists of the apps which actually implement that phase
+        self.incoming_dispatch = {}
+        self.outgoing_dispatch = {}
+        self._dispatch_apps = None
+        self._dispatch_len = 0
+
         # we need to be started
         self.started = False
 
@@ -48,33 +143,127 @@ class HttpRouter(object, LoggerMixin):
         Normalizes the passed in number, they should be only digits, some backends prepend + and
         maybe crazy users put in dashes or parentheses in the console.
         """
-        return re.sub('[^0-9a-z]', '', number.lower())
+        if isinstance(number, str):
+            if number.isdigit():
+                return number
+            return number.lower().translate(None, NUMBER_DELETE_CHARS)
 
-    def add_message(self, backend, contact, text, direction, status):
+        # most numbers we get are already normalized, skip building a new string for them
+        if NUMBER_PATTERN.search(number) is None:
+            return number
+        return NUMBER_PATTERN.sub(u'', number.lower())
+
+    @classmethod
+    def normalize_numbers(cls, numbers):
         """
-        Adds this message to the db.  This is both for logging, and we also keep state
-        tied to it.
+        Normalizes every number in the passed in iterable, returning a list.
+        """
+        normalize_number = cls.normalize_number
+        return [normalize_number(number) for number in numbers]
+
+    @classmethod
+    def implements_phase(cls, app, phase):
+        """
+        Returns whether the passed in app overrides the no-op implementation of the
+        given phase that AppBase provides.
         """
+        impl = getattr(type(app), phase, None)
+        if impl is None:
+            return False
 
-        # lookup / create this backend
-        # TODO: is this too flexible?  Perhaps we should do this upon initialization and refuse
-        # any backends not found in our settings.  But I hate dropping messages on the floor.
-        backend, created = Backend.objects.get_or_create(name=backend)
+        default = getattr(AppBase, phase, None)
+        return getattr(impl, '__func__', impl) is not getattr(default, '__func__', default)
 
-        contact = HttpRouter.normalize_number(contact)
+    def build_dispatch_tables(self):
+        """
+        Precomputes, for every phase, the list of apps which need to be called.  Apps which
+        only inherit the AppBase defaults for a phase are left out of that phase's table.
+        Outgoing tables are stored in reverse app order.
+        """
+        self.incoming_dispatch = dict((phase, [app for app in self.apps if self.implements_phase(app, phase)])
+                                      for phase in self.incoming_phases)
+        self.outgoing_dispatch = dict((phase, [app for app in reversed(self.apps) if self.implements_phase(app, phase)])
+                                      for phase in self.outgoing_phases)
+        self._dispatch_apps = self.apps
+        self._dispatch_len = len(self.apps)
+
+    def _check_dispatch_tables(self):
+        # self.apps is public and sometimes replaced or appended to directly, rebuild if it looks
+        # changed.  This runs for every phase of every message so only compares identity and length,
+        # apps replaced in place need an explicit build_dispatch_tables()
+        if self._dispatch_apps is not self.apps or self._dispatch_len != len(self.apps):
+            self.build_dispatch_tables()
+
+    def apps_for_incoming_phase(self, phase):
+        self._check_dispatch_tables()
+        return self.incoming_dispatch[phase]
+
+    def apps_for_outgoing_phase(self, phase):
+        self._check_dispatch_tables()
+        return self.outgoing_dispatch[phase]
+
+    def lookup_backend(self, name):
+        """
+        Returns the backend with the passed in name, creating it if it doesn't exist yet.
+        """
+        backend = backend_cache.get(name)
+        if backend is None:
+            # TODO: is this too flexible?  Perhaps we should do this upon initialization and refuse
+            # any backends not found in our settings.  But I hate dropping messages on the floor.
+            backend, created = Backend.objects.get_or_create(name=name)
+
+            # newly created rows might still be rolled back, only cache ones we read
+            if not created:
+                backend_cache.set(name, backend, tag=backend.pk)
+
+        return backend
 
-        # create our connection
-        #connection, created = Connection.objects.get_or_create(backend=backend, identity=contact)
-        if getattr(settings, 'CREATE_NEW_CONNECTION_IF_MISSING', True):
+    def lookup_connection(self, backend, identity):
+        """
+        Returns the connection for the passed in (already normalized) identity, creating
+        it on the passed in backend if it doesn't exist yet.
+
+        Cached connections are handed out as fresh instances so that callers never share
+        related object caches (contact etc..) across messages.
+        """
+        create_new = getattr(settings, 'CREATE_NEW_CONNECTION_IF_MISSING', True)
+        key = (backend.pk if create_new else None, identity)
+
+        values = connection_cache.get(key)
+        if values is not None:
+            connection = Connection(**values)
+            if connection.backend_id == backend.pk:
+                connection.backend = backend
+            return connection
+
+        created = False
+        if create_new:
             # if set to True will create new connection with (identity, backend) pair
-            connection, created = Connection.objects.get_or_create(backend=backend, identity=contact)
+            connection, created = Connection.objects.get_or_create(backend=backend, identity=identity)
         else:
             try:
-                connection = Connection.objects.get(identity=contact)
+                connection = Connection.objects.get(identity=identity)
             except Connection.DoesNotExist:
-                connection = Connection.objects.create(backend=backend, identity=contact)
+                connection = Connection.objects.create(backend=backend, identity=identity)
+                created = True
             except Connection.MultipleObjectsReturned:
-                connection = Connection.objects.filter(identity=contact)[0]
+                connection = Connection.objects.filter(identity=identity)[0]
+
+        if not created:
+            values = dict((field.attname, getattr(connection, field.attname)) for field in Connection._meta.fields)
+            connection_cache.set(key, values, tag=connection.pk)
+
+        return connection
+
+    def add_message(self, backend, contact, text, direction, status):
+        """
+        Adds this message to the db.  This is both for logging, and we also keep state
+        tied to it.
+        """
+
+        backend = self.lookup_backend(backend)
+        contact = HttpRouter.normalize_number(contact)
+        connection = self.lookup_connection(backend, contact)
 
         # finally, create our db message
         message = Message.objects.create(connection=connection,
@@ -84,14 +273,107 @@ class HttpRouter(object, LoggerMixin):
 
         return message
 
+    def add_messages(self, messages, direction, status):
+        """
+        Bulk version of add_message, takes a list of (backend, contact, text) tuples and
+        returns the created messages in the same order.  Backends and connections are
+        looked up with one query each and, on PostgreSQL, the messages are inserted with
+        a single multi-row INSERT.
+        """
+        if not messages:
+            return []
+
+        backends = dict((backend.name, backend) for backend in
+                        Backend.objects.filter(name__in=set(name for name, contact, text in messages)))
+        for name, contact, text in messages:
+            if name not in backends:
+                backends[name] = self.lookup_backend(name)
+
+        identities = HttpRouter.normalize_numbers([contact for name, contact, text in messages])
+        rows = [(backends[name], identity, text) for (name, contact, text), identity in zip(messages, identities)]
+        identities = set(identity for backend, identity, text in rows)
+
+        create_new = getattr(settings, 'CREATE_NEW_CONNECTION_IF_MISSING', True)
+        connections = {}
+        existing = Connection.objects.filter(identity__in=identities).order_by('-id')
+        if create_new:
+            existing = existing.filter(backend__in=[backend.pk for backend in backends.values()])
+        for connection in existing:
+            connections[(connection.backend_id if create_new else None, connection.identity)] = connection
+
+        message_connections = []
+        for backend, identity, text in rows:
+            key = (backend.pk if create_new else None, identity)
+            if key not in connections:
+                connections[key] = self.lookup_connection(backend, identity)
+            message_connections.append(connections[key])
+
+        date = datetime.datetime.now()
+        if is_postgresql(Message.objects.db):
+            sql = 'insert into rapidsms_httprouter_message (text, date, direction, status, connection_id, priority) values '
+            insert_list = []
+            params_list = []
+            for connection, (backend, identity, text) in zip(message_connections, rows):
+                insert_list.append("(%s, %s, %s, %s, %s, %s)")
+                params_list += [text, date, direction, status, connection.pk, 10]
+
+            cursor = connections_by_alias[Message.objects.db].cursor()
+            cursor.execute("%s %s returning id" % (sql, ",".join(insert_list)), params_list)
+            ids = [row[0] for row in cursor.fetchall()]
+            transaction.commit_unless_managed()
+
+            return [Message(id=pk, connection=connection, text=text, direction=direction, status=status,
+                            date=date, priority=10)
+                    for pk, connection, (backend, identity, text) in zip(ids, message_connections, rows)]
+        else:
+            return [Message.objects.create(connection=connection, text=text, direction=direction, status=status)
+                    for connection, (backend, identity, text) in zip(message_connections, rows)]
+
     def mark_delivered(self, message_id):
         """
         Marks a message as delivered by the backend.
         """
 
-        message = Message.objects.get(pk=message_id)
-        message.status = 'D'
-        message.save()
+        Message.objects.filter(pk=message_id).update(status='D')
+
+    def mark_statuses(self, receipts, chunk_size=500):
+        """
+        Applies the passed in delivery receipts, an iterable of (message id, status)
+        pairs, with one UPDATE per status and chunk_size ids.  Returns how many messages
+        were updated.
+        """
+        by_status = {}
+        for message_id, status in receipts:
+            by_status.setdefault(status, []).append(message_id)
+
+        updated = 0
+        for status, message_ids in by_status.items():
+            for i in range(0, len(message_ids), chunk_size):
+                updated += Message.objects.filter(pk__in=message_ids[i:i + chunk_size]).update(status=status)
+
+        return updated
+
+    def status_write_behind(self):
+        """
+        Returns how the final state of incoming messages is written.  None saves the
+        message (the default), 'update' issues a single UPDATE of status and application
+        per message and 'batch' hands them off to be flushed in bulk.
+        """
+        return getattr(settings, 'ROUTER_STATUS_WRITE_BEHIND', None)
+
+    def save_handled(self, db_message):
+        """
+        Persists the status and application of an incoming message once it has been
+        through all the incoming phases.
+        """
+        mode = self.status_write_behind()
+        if mode == 'batch':
+            incoming_status_writer.add(db_message.pk, db_message.status, db_message.application)
+        elif mode:
+            Message.objects.filter(pk=db_message.pk).update(status=db_message.status,
+                                                            application=db_message.application)
+        else:
+            db_message.save()
 
     def handle_incoming(self, backend, sender, text):
         """
@@ -100,6 +382,21 @@ class HttpRouter(object, LoggerMixin):
         # create our db message for logging
         db_message = self.add_message(backend, sender, text, 'I', 'R')
 
+        return self.process_incoming(db_message)
+
+    def handle_incoming_bulk(self, messages):
+        """
+        Handles a list of incoming (backend, sender, text) tuples, inserting them all at
+        once before passing each through the incoming phases.
+        """
+        return [self.process_incoming(db_message) for db_message in self.add_messages(messages, 'I', 'R')]
+
+    def process_incoming(self, db_message):
+        """
+        Passes an already logged incoming message through all our apps.
+        """
+        text = db_message.text
+
         # and our rapidsms transient message for processing
         msg = IncomingMessage(db_message.connection, text, db_message.date)
 
@@ -116,7 +413,7 @@ class HttpRouter(object, LoggerMixin):
                         self.debug("Skipping phase")
                         break
 
-                for app in self.apps:
+                for app in self.apps_for_incoming_phase(phase):
                     self.debug("In %s app" % app)
                     handled = False
 
@@ -146,7 +443,8 @@ class HttpRouter(object, LoggerMixin):
                             # default phase firing unnecessarily
                             msg.handled = True
                             db_message.application = app
-                            db_message.save()
+                            if not self.status_write_behind():
+                                db_message.save()
                             break
 
                     elif phase == "default":
@@ -161,14 +459,14 @@ class HttpRouter(object, LoggerMixin):
 
         db_message.status = 'H'
         try:
-            db_message.save()
+            self.save_handled(db_message)
         except DatabaseError:
             try:
                 transaction.rollback()
             except:
                 pass
             db_message.status = 'H'
-            db_message.save()
+            self.save_handled(db_message)
 
         # now send the message responses
         while msg.responses:
@@ -201,6 +499,9 @@ class HttpRouter(object, LoggerMixin):
                 db_message.status = 'Q'
                 db_message.save()
 
+        if db_message.status == 'Q':
+            notify_outbox(using=db_message._state.db)
+
         return db_message
 
     def handle_outgoing(self, msg, source=None, application=None):
@@ -231,7 +532,7 @@ class HttpRouter(object, LoggerMixin):
             # call outgoing phases in the opposite order of the incoming
             # phases, so the first app called with an  incoming message
             # is the last app called with an outgoing message
-            for app in reversed(self.apps):
+            for app in self.apps_for_outgoing_phase(phase):
                 self.debug("Out %s app" % app)
 
                 try:
@@ -278,6 +579,7 @@ class HttpRouter(object, LoggerMixin):
 
         app = cls(self)
         self.apps.append(app)
+        self.build_dispatch_tables()
         return app
 
     def start(self, start_workers=False):
@@ -293,6 +595,9 @@ class HttpRouter(object, LoggerMixin):
         for app in self.apps:
             app.start()
 
+        # work out which apps take part in which phases once, rather than per message
+        self.build_dispatch_tables()
+
         # the list of messages which need to be sent, we load this from the DB
         # upon first starting up
         self.outgoing = Message.objects.filter(status='Q')
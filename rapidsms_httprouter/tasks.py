@@ -27,7 +27,7 @@ def handle_incoming(router,backend, sender, text,ignore_result=True,**kwargs):
                     router.debug("Skipping phase")
                     break
 
-            for app in router.apps:
+            for app in router.apps_for_incoming_phase(phase):
                 router.debug("In %s app" % app)
                 handled = False
 
@@ -57,7 +57,8 @@ def handle_incoming(router,backend, sender, text,ignore_result=True,**kwargs):
                         # default phase firing unnecessarily
                         msg.handled = True
                         db_message.application = app
-                        db_message.save()
+                        if not router.status_write_behind():
+                            db_message.save()
                         break
 
                 elif phase == "default":
@@ -71,7 +72,7 @@ def handle_incoming(router,backend, sender, text,ignore_result=True,**kwargs):
         pass
 
     db_message.status = 'H'
-    db_message.save()
+    router.save_handled(db_message)
 
     db_responses = []
 
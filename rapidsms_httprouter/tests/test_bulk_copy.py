@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import datetime
+from unittest import TestCase
+from mock import MagicMock, Mock, patch
+from rapidsms_httprouter.bulk_copy import build_buffer
+from rapidsms_httprouter.managers import BulkInsertManager
+
+
+class BuildBufferTest(TestCase):
+
+    def test_values_are_quoted_and_nulls_are_not(self):
+        rows = [(u'say "hi"', None, 10), (u'', True, datetime.datetime(2013, 1, 2, 3, 4, 5))]
+        self.assertEqual('"say ""hi""",\\N,"10"\n"","t","2013-01-02T03:04:05"\n', build_buffer(rows).read())
+
+    def test_unicode_is_encoded(self):
+        self.assertEqual('"gw\xc3\xa9"\n', build_buffer([(u'gwé',)]).read())
+
+
+class CopyInsertTest(TestCase):
+
+    def setUp(self):
+        self.fields = [Mock(column='text'), Mock(column='connection_id')]
+        self.fields[0].name = 'text'
+        self.fields[1].name = 'connection'
+        self.queue = {'a': {'text': u'one', 'connection': 3}, 'b': {'text': u'two', 'connection': 4}}
+        self.order = [('b', 0), ('a', 1)]
+
+    def test_rows_are_copied_with_ids_reserved_in_order(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [(7,), (8,)]
+        loaded = []
+        cursor.copy_expert.side_effect = lambda sql, buf: loaded.append((sql, buf.read()))
+
+        ids = BulkInsertManager().copy_insert(cursor, 'rapidsms_httprouter_message', self.fields,
+                                              self.queue, self.order)
+
+        self.assertEqual([(7,), (8,)], ids)
+        self.assertTrue('nextval' in cursor.execute.call_args[0][0])
+        self.assertEqual(['rapidsms_httprouter_message', 2], cursor.execute.call_args[0][1])
+
+        sql, rows = loaded[0]
+        self.assertTrue(sql.startswith('COPY ') and 'FROM STDIN' in sql)
+        columns = sql[sql.index('(') + 1:sql.index(')')].split(',')
+        self.assertEqual(['id', 'text', 'connection_id'], [column.strip().strip('"') for column in columns])
+        self.assertEqual('"7","two","4"\n"8","one","3"\n', rows)
+
+    def test_default_inserts_use_copy_when_enabled(self):
+        manager = BulkInsertManager()
+        with patch('rapidsms_httprouter.managers.copy_enabled', return_value=True):
+            with patch('rapidsms_httprouter.managers.connection'):
+                with patch.object(manager, 'copy_insert', return_value=[(7,)]) as copy_insert:
+                    self.assertEqual([(7,)], manager.insert('rapidsms_httprouter_message', self.fields,
+                                                            self.queue, self.order))
+
+        self.assertTrue(copy_insert.called)
@@ -0,0 +1,41 @@
+from unittest import TestCase
+from rapidsms_httprouter.cache import LRUCache
+from mock import patch
+
+
+class LRUCacheTest(TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_expired_entries_are_not_returned(self):
+        cache = LRUCache(max_size=2, ttl=10)
+        with patch('time.time', return_value=100):
+            cache.set('a', 1)
+        with patch('time.time', return_value=105):
+            self.assertEqual(1, cache.get('a'))
+        with patch('time.time', return_value=111):
+            self.assertEqual(None, cache.get('a'))
+
+    def test_delete_tag_drops_every_key_with_that_tag(self):
+        cache = LRUCache(max_size=10)
+        cache.set((1, '256777'), 'conn', tag=5)
+        cache.set((None, '256777'), 'conn', tag=5)
+        cache.set((1, '256778'), 'other', tag=6)
+        cache.delete_tag(5)
+
+        self.assertEqual(1, len(cache))
+        self.assertEqual('other', cache.get((1, '256778')))
+
+    def test_zero_size_cache_stores_nothing(self):
+        cache = LRUCache(max_size=0)
+        cache.set('a', 1)
+        self.assertEqual(None, cache.get('a'))
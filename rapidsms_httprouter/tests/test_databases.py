@@ -0,0 +1,20 @@
+from unittest import TestCase
+from mock import MagicMock, patch
+from rapidsms_httprouter.databases import is_postgresql, is_sqlite
+
+
+class DatabasesTest(TestCase):
+
+    def connections(self, engine, vendor):
+        connection = MagicMock(vendor=vendor, settings_dict={'ENGINE': engine})
+        return patch('rapidsms_httprouter.databases.connections', {'default': connection})
+
+    def test_postgis_is_postgresql(self):
+        with self.connections('django.contrib.gis.db.backends.postgis', 'postgresql'):
+            self.assertTrue(is_postgresql())
+            self.assertFalse(is_sqlite())
+
+    def test_sqlite_is_not_postgresql(self):
+        with self.connections('django.db.backends.sqlite3', 'sqlite'):
+            self.assertFalse(is_postgresql('default'))
+            self.assertTrue(is_sqlite('default'))
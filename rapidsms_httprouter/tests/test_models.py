@@ -0,0 +1,125 @@
+import datetime
+
+from django.db.models.query import QuerySet
+from django.test import TestCase
+from rapidsms.models import Backend, Connection
+from rapidsms_httprouter.models import Message, mass_text_sent
+
+
+class MessageLeaseTest(TestCase):
+    def setUp(self):
+        backend = Backend.objects.create(name="lease_backend")
+        self.messages = [Message.objects.create(connection=Connection.objects.create(backend=backend, identity=str(i)),
+                                                text="lease", direction='O', status='Q')
+                         for i in range(3)]
+
+    def test_leased_messages_are_locked_and_not_leased_again(self):
+        queue = Message.objects.filter(direction='O').order_by('id')
+        first = queue.lease(2)
+        second = queue.lease(2)
+
+        self.assertEqual([m.pk for m in self.messages[:2]], first)
+        self.assertEqual([self.messages[2].pk], second)
+        self.assertEqual(3, Message.objects.filter(status='L', lease_expires__isnull=False).count())
+        self.assertEqual([], queue.lease(2))
+
+    def test_expired_leases_are_reclaimed(self):
+        leased = Message.objects.filter(direction='O').lease(3)
+        Message.objects.filter(pk=leased[0]).update(lease_expires=datetime.datetime.now() - datetime.timedelta(seconds=1))
+
+        self.assertEqual([leased[0]], Message.objects.filter(direction='O').lease(3))
+
+    def test_locked_messages_without_a_lease_are_left_alone(self):
+        Message.objects.filter(pk=self.messages[0].pk).update(status='L')
+        Message.objects.reclaim_expired_leases()
+
+        self.assertEqual('L', Message.objects.get(pk=self.messages[0].pk).status)
+
+
+class MessageTextLookupTest(TestCase):
+    def setUp(self):
+        backend = Backend.objects.create(name="search_backend")
+        self.connection = Connection.objects.create(backend=backend, identity="256777000111")
+        self.question = Message.objects.create(connection=self.connection, text="What is your name?",
+                                               direction='O', status='S')
+        self.answer = Message.objects.create(connection=self.connection, text="Jane", direction='I',
+                                             status='H', in_response_to=self.question)
+
+    def test_with_text_only_matches_exact_text(self):
+        self.assertEqual([self.answer], list(Message.objects.with_text("Jane")))
+        self.assertEqual([], list(Message.objects.with_text("jan")))
+
+    def test_search_matches_text_responses_and_identity(self):
+        # the answer matches through the text of the question it responds to
+        self.assertEqual([self.question, self.answer], list(Message.objects.search(["your"]).order_by('id')))
+        self.assertEqual([self.answer], list(Message.objects.search(["jane"])))
+        self.assertEqual(2, Message.objects.search(["777000"]).count())
+
+    def test_search_requires_every_term_to_match(self):
+        self.assertEqual([self.answer], list(Message.objects.search(["name", "jane"])))
+        self.assertEqual([], list(Message.objects.search(["name", "bob"])))
+
+
+class MassTextStreamTest(TestCase):
+    def setUp(self):
+        backend = Backend.objects.create(name="stream_backend")
+        self.connections = [Connection.objects.create(backend=backend, identity=str(25677000000 + i))
+                            for i in range(5)]
+
+    def test_messages_are_inserted_in_chunks_from_connection_ids(self):
+        batch, count = Message.mass_text_stream("blast", iter([c.pk for c in self.connections]), chunk_size=2)
+
+        self.assertEqual(5, count)
+        self.assertEqual(5, batch.queued)
+        self.assertEqual(sorted(c.pk for c in self.connections),
+                         sorted(batch.messages.values_list('connection_id', flat=True)))
+        self.assertEqual(set(['P']), set(batch.messages.values_list('status', flat=True)))
+
+    def test_a_queryset_of_connections_can_be_passed(self):
+        batch, count = Message.mass_text_stream("blast", Connection.objects.filter(backend__name="stream_backend"),
+                                                status='Q', batch_name="stream")
+
+        self.assertEqual(5, count)
+        self.assertEqual("stream", batch.name)
+        self.assertEqual(5, batch.messages.filter(status='Q', direction='O', text="blast").count())
+
+
+class MassTextSentSignalTest(TestCase):
+    def setUp(self):
+        backend = Backend.objects.create(name="signal_backend")
+        self.connections = [Connection.objects.create(backend=backend, identity=str(25678000000 + i))
+                            for i in range(5)]
+        self.received = []
+        mass_text_sent.connect(self.receiver)
+
+    def tearDown(self):
+        mass_text_sent.disconnect(self.receiver)
+
+    def receiver(self, sender, **kwargs):
+        self.received.append(kwargs)
+
+    def test_receivers_get_a_lazy_chunked_payload(self):
+        batch, count = Message.mass_text_stream("blast", self.connections, chunk_size=2)
+
+        self.assertEqual(1, len(self.received))
+        kwargs = self.received[0]
+        messages = kwargs['batch_messages']
+        self.assertEqual(batch.pk, kwargs['batch_id'])
+        self.assertEqual(5, kwargs['count'])
+        self.assertEqual(5, len(messages))
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in messages.chunks()])
+
+        pks = sorted(batch.messages.values_list('pk', flat=True))
+        self.assertEqual(pks, list(messages.iter_ids()))
+        self.assertEqual(pks, [m.pk for m in messages])
+        self.assertEqual((pks[0], pks[-1]), messages.id_range())
+
+    def test_messages_are_still_a_queryset(self):
+        batch, count = Message.mass_text_stream("blast", self.connections)
+        messages = self.received[0]['messages']
+        pks = sorted(batch.messages.values_list('pk', flat=True))
+
+        self.assertTrue(isinstance(messages, QuerySet))
+        self.assertEqual(pks, sorted(Message.objects.filter(pk__in=messages).values_list('pk', flat=True)))
+        self.assertEqual(pks[0], messages.order_by('pk')[0].pk)
+        self.assertEqual(5, messages.filter(status='P').count())
@@ -0,0 +1,43 @@
+from django.core.management import call_command
+from django.test import TestCase
+from rapidsms.models import Backend, Connection
+
+
+class NormalizeConnectionsTest(TestCase):
+    def setUp(self):
+        self.backend = Backend.objects.create(name="normalize_backend")
+        self.other_backend = Backend.objects.create(name="normalize_other")
+
+        self.plus = Connection.objects.create(backend=self.backend, identity='+256700000001')
+        self.dashes = Connection.objects.create(backend=self.backend, identity='256-700-000001')
+        self.existing = Connection.objects.create(backend=self.backend, identity='256700000002')
+        self.collision = Connection.objects.create(backend=self.backend, identity='+256700000002')
+        self.other = Connection.objects.create(backend=self.other_backend, identity='+256700000002')
+        self.letters = Connection.objects.create(backend=self.backend, identity='ASDF')
+
+    def assertNormalized(self):
+        identity = lambda connection: Connection.objects.get(pk=connection.pk).identity
+
+        # the first of two connections normalizing to the same identity wins
+        self.assertEqual('256700000001', identity(self.plus))
+        self.assertEqual('256-700-000001', identity(self.dashes))
+
+        # connections colliding with an existing one are left alone, but only within their backend
+        self.assertEqual('+256700000002', identity(self.collision))
+        self.assertEqual('256700000002', identity(self.other))
+
+        self.assertEqual('asdf', identity(self.letters))
+
+    def test_connections_are_normalized_in_batches(self):
+        call_command('normalizeconnections', batch_size=2)
+        self.assertNormalized()
+
+    def test_connections_are_normalized_row_by_row(self):
+        call_command('normalizeconnections', batch_size=2, row_by_row=True)
+        self.assertNormalized()
+
+    def test_runs_can_be_resumed(self):
+        call_command('normalizeconnections', start_id=self.existing.pk)
+
+        self.assertEqual('+256700000001', Connection.objects.get(pk=self.plus.pk).identity)
+        self.assertEqual('asdf', Connection.objects.get(pk=self.letters.pk).identity)
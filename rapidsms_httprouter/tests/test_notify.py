@@ -0,0 +1,53 @@
+from unittest import TestCase
+from django.conf import settings
+from mock import patch
+from rapidsms_httprouter.notify import notify_outbox, OutboxListener
+
+
+class NotifyOutboxTest(TestCase):
+
+    def setUp(self):
+        settings.ROUTER_NOTIFY_OUTBOX = True
+        settings.ROUTER_NOTIFY_PORT = 13131
+
+    def tearDown(self):
+        settings.ROUTER_NOTIFY_OUTBOX = False
+
+    def test_nothing_is_sent_when_disabled(self):
+        settings.ROUTER_NOTIFY_OUTBOX = False
+        with patch('rapidsms_httprouter.notify.connections') as connections:
+            notify_outbox()
+        self.assertFalse(connections.__getitem__.called)
+
+    def test_notification_is_committed_on_postgres(self):
+        with patch('rapidsms_httprouter.notify.is_postgresql', return_value=True):
+            with patch('rapidsms_httprouter.notify.connections') as connections:
+                with patch('rapidsms_httprouter.notify.transaction') as transaction:
+                    notify_outbox(using='default')
+
+        connections['default'].cursor().execute.assert_called_with('NOTIFY httprouter_outbox')
+        transaction.commit_unless_managed.assert_called_with(using='default')
+
+    def test_listener_is_woken_up_by_notifications(self):
+        with patch('rapidsms_httprouter.notify.is_postgresql', return_value=False):
+            listener = OutboxListener(['default'])
+            try:
+                notify_outbox()
+                notify_outbox()
+                self.assertTrue(listener.wait(1))
+
+                # notifications which piled up are drained at once
+                self.assertFalse(listener.wait(0))
+            finally:
+                listener.close()
+
+    def test_wait_times_out_without_notifications(self):
+        with patch('rapidsms_httprouter.notify.is_postgresql', return_value=False):
+            listener = OutboxListener(['default'])
+            try:
+                self.assertFalse(listener.wait(0.1))
+            finally:
+                listener.close()
+
+    def test_wait_returns_straight_away_without_databases_to_listen_on(self):
+        self.assertFalse(OutboxListener([]).wait(5))
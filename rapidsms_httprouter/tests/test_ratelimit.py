@@ -0,0 +1,40 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+from rapidsms_httprouter.ratelimit import TokenBucket
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.bucket = TokenBucket(self.path, rate=10, burst=20)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    @patch('time.time', return_value=1000.0)
+    def test_burst_can_be_taken_at_once(self, mock_time):
+        self.assertEqual(0, self.bucket.take(20))
+        self.assertAlmostEqual(0.5, self.bucket.take(5))
+
+    def test_bucket_refills_at_the_sustained_rate(self):
+        with patch('time.time', return_value=1000.0):
+            self.bucket.take(20)
+        with patch('time.time', return_value=1001.0):
+            self.assertEqual(0, self.bucket.take(10))
+            self.assertAlmostEqual(0.1, self.bucket.take(1))
+
+    def test_chunks_larger_than_the_burst_go_into_debt(self):
+        with patch('time.time', return_value=1000.0):
+            self.assertEqual(0, self.bucket.take(40))
+        with patch('time.time', return_value=1002.0):
+            # we are still 20 tokens short, 2 seconds later we have only paid back the debt
+            self.assertAlmostEqual(1.0, self.bucket.take(10))
+
+    def test_state_is_shared_between_buckets_on_the_same_file(self):
+        with patch('time.time', return_value=1000.0):
+            self.bucket.take(20)
+            self.assertTrue(TokenBucket(self.path, rate=10, burst=20).take(1) > 0)
@@ -0,0 +1,174 @@
+from django.conf import settings
+from django.test import TestCase
+from mock import patch
+from rapidsms.apps.base import AppBase
+from rapidsms.models import Backend, Connection
+from rapidsms_httprouter.models import Message
+from django.core.management import call_command
+from rapidsms_httprouter.cache import LRUCache
+from rapidsms_httprouter.router import HttpRouter, IncomingStatusWriter
+
+
+class HandleOnlyApp(AppBase):
+    def handle(self, msg):
+        return True
+
+
+class OutgoingOnlyApp(AppBase):
+    def outgoing(self, msg):
+        return True
+
+
+class DispatchTablesTest(TestCase):
+    def setUp(self):
+        self.router = HttpRouter()
+        self.handle_app = HandleOnlyApp(self.router)
+        self.outgoing_app = OutgoingOnlyApp(self.router)
+        self.router.apps = [self.handle_app, self.outgoing_app]
+
+    def test_only_apps_overriding_a_phase_are_dispatched_to(self):
+        self.assertEqual([self.handle_app], self.router.apps_for_incoming_phase('handle'))
+        self.assertEqual([], self.router.apps_for_incoming_phase('filter'))
+        self.assertEqual([self.outgoing_app], self.router.apps_for_outgoing_phase('outgoing'))
+
+    def test_tables_are_rebuilt_when_apps_change(self):
+        self.router.build_dispatch_tables()
+        other_handle_app = HandleOnlyApp(self.router)
+        self.router.apps.insert(0, other_handle_app)
+        self.assertEqual([other_handle_app, self.handle_app], self.router.apps_for_incoming_phase('handle'))
+
+    def test_tables_are_rebuilt_when_apps_are_replaced(self):
+        self.router.build_dispatch_tables()
+        other_handle_app = HandleOnlyApp(self.router)
+        self.router.apps = [other_handle_app, self.outgoing_app]
+        self.assertEqual([other_handle_app], self.router.apps_for_incoming_phase('handle'))
+
+
+class StatusWriteBehindTest(TestCase):
+    def setUp(self):
+        self.router = HttpRouter()
+        self.handle_app = HandleOnlyApp(self.router)
+        self.router.apps = [self.handle_app]
+
+    def tearDown(self):
+        settings.ROUTER_STATUS_WRITE_BEHIND = None
+
+    def test_update_mode_writes_status_and_application_with_a_single_update(self):
+        settings.ROUTER_STATUS_WRITE_BEHIND = 'update'
+        db_message = self.router.add_message('write_behind', '256777', 'hi', 'I', 'R')
+        with patch.object(db_message, 'save') as save:
+            with patch.object(Message.objects, 'filter', wraps=Message.objects.filter) as filtered:
+                self.router.process_incoming(db_message)
+
+        self.assertFalse(save.called)
+        filtered.assert_called_once_with(pk=db_message.pk)
+
+        stored = Message.objects.get(pk=db_message.pk)
+        self.assertEqual('H', stored.status)
+        self.assertEqual(unicode(self.handle_app), stored.application)
+
+    def test_batch_mode_queues_the_status_for_the_writer(self):
+        settings.ROUTER_STATUS_WRITE_BEHIND = 'batch'
+        with patch('rapidsms_httprouter.router.incoming_status_writer') as writer:
+            db_message = self.router.handle_incoming('write_behind', '256777', 'hi')
+
+        writer.add.assert_called_once_with(db_message.pk, 'H', self.handle_app)
+        self.assertEqual('R', Message.objects.get(pk=db_message.pk).status)
+
+
+class IncomingStatusWriterTest(TestCase):
+    def setUp(self):
+        connection = Connection.objects.create(backend=Backend.objects.create(name="writer"), identity='256777')
+        self.messages = [Message.objects.create(connection=connection, text="in %d" % i, direction='I', status='R')
+                         for i in range(3)]
+        self.writer = IncomingStatusWriter(interval=60)
+
+    def tearDown(self):
+        if self.writer.timer is not None:
+            self.writer.timer.cancel()
+
+    def test_flush_writes_pending_statuses_grouped_by_status_and_application(self):
+        self.writer.add(self.messages[0].pk, 'H', 'poll')
+        self.writer.add(self.messages[1].pk, 'H', 'poll')
+        self.writer.add(self.messages[2].pk, 'H')
+
+        with patch('rapidsms_httprouter.router.close_connection'):
+            with patch.object(Message.objects, 'filter', wraps=Message.objects.filter) as filtered:
+                self.writer.flush()
+
+        # one update per distinct (status, application)
+        self.assertEqual(2, filtered.call_count)
+        self.assertEqual([('H', 'poll'), ('H', 'poll'), ('H', None)],
+                         [(m.status, m.application) for m in
+                          Message.objects.filter(pk__in=[m.pk for m in self.messages]).order_by('id')])
+        self.assertEqual({}, self.writer.pending)
+        self.assertEqual(None, self.writer.timer)
+
+    def test_later_statuses_replace_pending_ones(self):
+        self.writer.add(self.messages[0].pk, 'R')
+        self.writer.add(self.messages[0].pk, 'H', 'poll')
+
+        self.assertEqual({self.messages[0].pk: ('H', u'poll')}, self.writer.pending)
+
+
+class NormalizeNumberTest(TestCase):
+    def test_numbers_are_stripped_to_lowercase_digits_and_letters(self):
+        for number in ('+256-700 (123) 456', u'+256-700 (123) 456'):
+            self.assertEqual('256700123456', HttpRouter.normalize_number(number))
+        self.assertEqual('asdfasdf', HttpRouter.normalize_number('asdfASDF'))
+        self.assertEqual(u'asdfasdf', HttpRouter.normalize_number(u'asdfASDF'))
+        self.assertEqual(u'256', HttpRouter.normalize_number(u'256\xe9'))
+
+    def test_normalized_numbers_are_returned_as_is(self):
+        number = u'256700123456'
+        self.assertTrue(HttpRouter.normalize_number(number) is number)
+
+    def test_numbers_are_normalized_in_bulk(self):
+        self.assertEqual(['256700123456', 'shortcode', ''],
+                         HttpRouter.normalize_numbers(iter(['+256700123456', u'ShortCode', '+'])))
+
+
+class ConnectionCacheTest(TestCase):
+    def setUp(self):
+        self.router = HttpRouter()
+        self.backend = Backend.objects.create(name="cache_backend")
+        self.connection = Connection.objects.create(backend=self.backend, identity='256700000001')
+
+        self.cache_patch = patch('rapidsms_httprouter.router.connection_cache', LRUCache(10))
+        self.cache_patch.start()
+
+    def tearDown(self):
+        self.cache_patch.stop()
+
+    def test_cached_connections_are_not_queried_again(self):
+        self.router.lookup_connection(self.backend, '256700000001')
+        with self.assertNumQueries(0):
+            connection = self.router.lookup_connection(self.backend, '256700000001')
+
+        self.assertEqual(self.connection.pk, connection.pk)
+        self.assertEqual(self.backend, connection.backend)
+
+    def test_saved_connections_are_dropped(self):
+        self.router.lookup_connection(self.backend, '256700000001')
+        self.connection.identity = '256700000002'
+        self.connection.save()
+
+        connection = self.router.lookup_connection(self.backend, '256700000001')
+        self.assertNotEqual(self.connection.pk, connection.pk)
+
+    def test_deleted_connections_are_dropped(self):
+        self.router.lookup_connection(self.backend, '256700000001')
+        self.connection.delete()
+
+        connection = self.router.lookup_connection(self.backend, '256700000001')
+        self.assertNotEqual(self.connection.pk, connection.pk)
+
+    def test_normalized_connections_are_dropped(self):
+        plus = Connection.objects.create(backend=self.backend, identity='+256700000003')
+        self.router.lookup_connection(self.backend, '+256700000003')
+
+        call_command('normalizeconnections')
+
+        connection = self.router.lookup_connection(self.backend, '+256700000003')
+        self.assertNotEqual(plus.pk, connection.pk)
+        self.assertEqual('256700000003', Connection.objects.get(pk=plus.pk).identity)
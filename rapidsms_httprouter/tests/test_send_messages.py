@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import threading
+
 from django.test import TestCase
 from mock import MagicMock, patch, Mock
 from django.conf import settings
@@ -103,6 +105,17 @@ class SendMessagesCommandTestCase(TestCase):
         self.assertEquals((Message.objects.get(pk=msg1.pk)).status, 'S')
         self.assertEquals((Message.objects.get(pk=msg2.pk)).status, 'S')
 
+    def test_chunks_are_sent_with_a_receipt_token_stored_on_their_messages(self):
+        msg1 = self.create_message(1, "fake")
+        msg2 = self.create_message(2, "fake")
+        urls = []
+        self.command.fetch_url = lambda url: urls.append(url) or 200
+        self.command.process_messages_for_db(10, "default", self.router_url + "&id=%(id)s")
+
+        self.assertEqual(1, len(urls))
+        self.assertTrue(urls[0].endswith("&id=%d" % msg1.pk))
+        self.assertEqual([msg1.pk, msg1.pk], [Message.objects.get(pk=m.pk).receipt_chunk for m in (msg1, msg2)])
+
     def test_process_messages_can_handle_a_non_routable_backend(self):
         msg1 = self.create_message(1, "fake")
         msg2 = self.create_message(2, "fake")
@@ -231,3 +244,289 @@ class SendMessagesBackendSupportTestCase(TestCase):
         backend = self.command.get_backend_class(self.config['vumi'], "vumi")
         self.assertTrue(isinstance(backend, BackendBase))
 
+
+
+class SendMessagesConcurrencyTestCase(TestCase):
+    def setUp(self):
+        self.command = Command()
+
+    def test_run_concurrently_starts_a_worker_per_db_with_its_own_command(self):
+        workers = []
+
+        def fake_run_db_worker(command, db_key, chunk_size, recipients):
+            workers.append((command, db_key))
+
+        with patch.object(Command, 'run_db_worker', fake_run_db_worker):
+            self.command.run_concurrently(["default", "other"], 10, None)
+
+        self.assertEqual(["default", "other"], sorted(db_key for command, db_key in workers))
+        self.assertTrue(all(command is not self.command for command, db_key in workers))
+        self.assertTrue(workers[0][0] is not workers[1][0])
+
+
+class SessionPoolTestCase(TestCase):
+    def tearDown(self):
+        settings.ROUTER_HTTP_CONFIG = {}
+        settings.ROUTER_HTTP_POOLING = False
+
+    def test_sessions_are_reused_per_host(self):
+        from rapidsms_httprouter.http_pool import SessionPool, get_http_config
+        pool = SessionPool()
+        config = get_http_config()
+        session = pool.get_session("http://kannel:13013/cgi-bin/sendsms?to=1", config)
+
+        self.assertTrue(session is pool.get_session("http://kannel:13013/cgi-bin/sendsms?to=2", config))
+        self.assertFalse(session is pool.get_session("http://other:13013/cgi-bin/sendsms?to=2", config))
+
+    def test_backend_config_overrides_default(self):
+        from rapidsms_httprouter.http_pool import get_http_config
+        settings.ROUTER_HTTP_CONFIG = {'default': {'read_timeout': 20}, 'aggregator': {'read_timeout': 30}}
+
+        self.assertEqual(20, get_http_config('other')['read_timeout'])
+        self.assertEqual(30, get_http_config('aggregator')['read_timeout'])
+
+    @patch('requests.Session.get')
+    def test_fetch_url_uses_the_session_pool_when_pooling(self, mock_get):
+        settings.ROUTER_HTTP_POOLING = True
+        mock_response = Mock()
+        mock_response.status_code = 202
+        mock_get.return_value = mock_response
+
+        self.assertEqual(202, Command().fetch_url("http://kannel:13013/cgi-bin/sendsms?to=1"))
+
+
+class BackendRegistryTestCase(TestCase):
+    def setUp(self):
+        from rapidsms_httprouter.management.commands.send_messages import BackendRegistry
+        self.registry = BackendRegistry()
+        self.build = Mock(side_effect=lambda config, name: object())
+
+    def test_backend_is_only_built_once_for_the_same_config(self):
+        config = {"ENGINE": "rapidsms.backends.vumi.VumiBackend", "sendsms_url": "http://2.2.2.1:9000/send/"}
+        backend = self.registry.get("vumi", config, self.build)
+
+        self.assertTrue(backend is self.registry.get("vumi", dict(config), self.build))
+        self.assertEqual(1, self.build.call_count)
+
+    def test_backend_is_rebuilt_when_its_config_changes(self):
+        config = {"ENGINE": "rapidsms.backends.vumi.VumiBackend", "sendsms_url": "http://2.2.2.1:9000/send/"}
+        backend = self.registry.get("vumi", config, self.build)
+        config["sendsms_url"] = "http://2.2.2.2:9000/send/"
+
+        self.assertFalse(backend is self.registry.get("vumi", config, self.build))
+        self.assertEqual(2, self.build.call_count)
+
+
+class SendMessagesAsyncCommandTestCase(TestCase):
+    def setUp(self):
+        from rapidsms_httprouter.management.commands.send_messages_async import Command as AsyncCommand
+        self.batch = MessageBatch.objects.create(status="Q", name="async", priority=1)
+        self.command = AsyncCommand()
+        self.command.db_key = "default"
+        self.command.fetch_url = lambda url: 403 if "400" in url else 200
+        self.router_url = "text=%(text)s&to=%(recipient)s&smsc=%(backend)s&%(priority)s"
+        self.recipients_per_request = getattr(settings, 'ASYNC_SEND_RECIPIENTS_PER_REQUEST', 100)
+
+    def tearDown(self):
+        settings.ASYNC_SEND_RECIPIENTS_PER_REQUEST = self.recipients_per_request
+
+    def create_message(self, identity, backend, batch=True, text="async"):
+        connection = Connection.objects.create(identity=str(identity),
+                                               backend=Backend.objects.get_or_create(name=backend)[0])
+        return Message.objects.create(status='Q', direction='O', text=text, connection=connection,
+                                      batch=self.batch if batch else None)
+
+    def test_chunks_for_every_backend_get_their_status_updated(self):
+        msgs = [self.create_message(1, "fake"), self.create_message(2, "fake"), self.create_message(400, "warid")]
+        self.command.send_all(self.router_url, msgs, 1)
+
+        self.assertEqual(['S', 'S', 'K'], [Message.objects.get(pk=m.pk).status for m in msgs])
+
+    def test_chunks_are_split_into_requests_of_limited_recipients(self):
+        settings.ASYNC_SEND_RECIPIENTS_PER_REQUEST = 2
+        urls = []
+        self.command.fetch_url = lambda url: urls.append(url) or 200
+        msgs = [self.create_message(i, "fake") for i in range(1, 6)]
+        self.command.send_all(self.router_url, msgs, 1)
+
+        self.assertEqual(3, len(urls))
+        self.assertTrue(all(Message.objects.get(pk=m.pk).status == 'S' for m in msgs))
+
+    def test_chunks_are_split_by_default(self):
+        self.assertEqual([range(100), range(100, 150)], self.command.split_chunk(range(150)))
+
+    def test_groups_of_individual_messages_are_all_in_flight_together(self):
+        msgs = [self.create_message(i, "fake", batch=False, text="reply %d" % i) for i in range(1, 4)]
+
+        # every request only succeeds once all three were started, so none may be waited for first
+        lock = threading.Lock()
+        all_started = threading.Event()
+        started = []
+
+        def fetch_url(url):
+            with lock:
+                started.append(url)
+                if len(started) == len(msgs):
+                    all_started.set()
+            all_started.wait(5)
+            return 200 if all_started.is_set() else 500
+
+        self.command.fetch_url = fetch_url
+        self.command.send_individual(self.router_url)
+
+        self.assertEqual(['S', 'S', 'S'], [Message.objects.get(pk=m.pk).status for m in msgs])
+
+
+class BatchCountersTestCase(TestCase):
+    def setUp(self):
+        self.command = Command()
+        self.command.fetch_url = lambda url: 403 if "400" in url else 200
+        self.router_url = "text=%(text)s&to=%(recipient)s&smsc=%(backend)s&%(priority)s"
+        self.batch = MessageBatch.objects.create(status="Q", name="counted", priority=1,
+                                                 queued=3, sent=0, cancelled=0, errored=0)
+        self.messages = [self.create_message(1, "counted"), self.create_message(2, "counted"),
+                         self.create_message(400, "discarded")]
+
+    def tearDown(self):
+        settings.SUPPORTED_BACKENDS = None
+
+    def create_message(self, identity, backend):
+        connection = Connection.objects.create(identity=str(identity),
+                                               backend=Backend.objects.get_or_create(name=backend)[0])
+        return Message.objects.create(status='Q', direction='O', text="counted", connection=connection,
+                                      batch=self.batch)
+
+    def test_counters_follow_the_statuses_set_while_sending(self):
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        batch = MessageBatch.objects.get(pk=self.batch.pk)
+        self.assertEqual((0, 2, 0, 1), (batch.queued, batch.sent, batch.cancelled, batch.errored))
+
+    def test_batch_with_errored_messages_is_cleared_once_sent(self):
+        self.command.process_messages_for_db(10, "default", self.router_url)
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        self.assertEqual('C', MessageBatch.objects.get(pk=self.batch.pk).status)
+
+    def test_batch_whose_messages_were_all_cancelled_is_cleared(self):
+        Message.objects.filter(batch=self.batch).update(status='C')
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        batch = MessageBatch.objects.get(pk=self.batch.pk)
+        self.assertEqual((0, 0, 3, 0), (batch.queued, batch.sent, batch.cancelled, batch.errored))
+        self.assertEqual('C', batch.status)
+
+    def test_batch_sent_outside_of_the_counters_is_sent(self):
+        Message.objects.filter(batch=self.batch).update(status='S')
+        MessageBatch.objects.filter(pk=self.batch.pk).update(queued=0)
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        batch = MessageBatch.objects.get(pk=self.batch.pk)
+        self.assertEqual((0, 3, 0, 0), (batch.queued, batch.sent, batch.cancelled, batch.errored))
+        self.assertEqual('S', batch.status)
+
+    def test_batch_with_counters_behind_its_queued_messages_is_not_cleared(self):
+        MessageBatch.objects.filter(pk=self.batch.pk).update(queued=0)
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        self.assertEqual('Q', MessageBatch.objects.get(pk=self.batch.pk).status)
+        self.assertEqual(['S', 'S'], [Message.objects.get(pk=m.pk).status for m in self.messages[:2]])
+
+    def test_batch_with_pending_messages_is_kept_without_blocking_others(self):
+        pending = MessageBatch.objects.create(status="Q", name="pending", priority=2,
+                                              queued=1, sent=0, cancelled=0, errored=0)
+        pending_message = Message.objects.create(status='P', direction='O', text="pending", batch=pending,
+                                                 connection=self.messages[0].connection)
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        self.assertEqual('Q', MessageBatch.objects.get(pk=pending.pk).status)
+        self.assertEqual('P', Message.objects.get(pk=pending_message.pk).status)
+        self.assertEqual('S', Message.objects.get(pk=self.messages[0].pk).status)
+
+    def test_batch_with_messages_cancelled_before_sending_does_not_block_others(self):
+        Message.objects.filter(pk=self.messages[0].pk).update(status='C')
+        later = MessageBatch.objects.create(status="Q", name="later", priority=0,
+                                            queued=1, sent=0, cancelled=0, errored=0)
+        later_message = Message.objects.create(status='Q', direction='O', text="later", batch=later,
+                                               connection=self.messages[0].connection)
+
+        # the first run sends what is left, the next finds nothing queued while the counters say otherwise
+        self.command.process_messages_for_db(10, "default", self.router_url)
+        self.assertEqual(1, MessageBatch.objects.get(pk=self.batch.pk).queued)
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        batch = MessageBatch.objects.get(pk=self.batch.pk)
+        self.assertEqual((0, 1, 1, 1), (batch.queued, batch.sent, batch.cancelled, batch.errored))
+        self.assertEqual('C', batch.status)
+
+        self.command.process_messages_for_db(10, "default", self.router_url)
+        self.assertEqual('S', Message.objects.get(pk=later_message.pk).status)
+
+    def test_completed_batch_with_cancelled_messages_is_sent(self):
+        Message.objects.filter(pk=self.messages[2].pk).update(status='C')
+        self.command.process_messages_for_db(10, "default", self.router_url)
+        self.command.process_messages_for_db(10, "default", self.router_url)
+
+        batch = MessageBatch.objects.get(pk=self.batch.pk)
+        self.assertEqual((0, 2, 1, 0), (batch.queued, batch.sent, batch.cancelled, batch.errored))
+        self.assertEqual('S', batch.status)
+
+    def test_count_transition_ignores_untracked_batches(self):
+        untracked = MessageBatch.objects.create(status="Q", name="untracked", priority=1)
+        MessageBatch.count_transition(untracked.pk, 'S', 5)
+
+        self.assertEqual(None, MessageBatch.objects.get(pk=untracked.pk).sent)
+
+
+class LeasingTestCase(TestCase):
+    def setUp(self):
+        settings.SEND_MESSAGES_LEASING = True
+        self.router_url = "text=%(text)s&to=%(recipient)s&smsc=%(backend)s&%(priority)s"
+        self.backend = Backend.objects.create(name="leasing")
+        self.batch = MessageBatch.objects.create(status="Q", name="leased", priority=1,
+                                                 queued=2, sent=0, cancelled=0, errored=0)
+        self.untracked = MessageBatch.objects.create(status="Q", name="untracked", priority=0)
+        self.messages = [self.create_message(identity, batch) for identity, batch in
+                         ((1, self.batch), (2, self.batch), (3, self.untracked))]
+
+    def tearDown(self):
+        settings.SEND_MESSAGES_LEASING = False
+
+    def create_message(self, identity, batch):
+        connection = Connection.objects.create(identity=str(identity), backend=self.backend)
+        return Message.objects.create(status='Q', direction='O', text="leased", connection=connection,
+                                      batch=batch)
+
+    def statuses(self, model, objects):
+        return [model.objects.get(pk=obj.pk).status for obj in objects]
+
+    def test_batches_leased_by_another_sender_are_left_alone(self):
+        Message.objects.filter(direction='O').lease(10)
+
+        command = Command()
+        command.fetch_url = Mock(return_value=200)
+        command.process_messages_for_db(10, "default", self.router_url)
+
+        self.assertFalse(command.fetch_url.called)
+        self.assertEqual(['L', 'L', 'L'], self.statuses(Message, self.messages))
+        self.assertEqual(['Q', 'Q'], self.statuses(MessageBatch, [self.batch, self.untracked]))
+
+    def test_two_senders_finish_the_batch_once(self):
+        first, second = Command(), Command()
+        second.fetch_url = Mock(return_value=200)
+        seen_while_sending = []
+
+        def fetch_url(url):
+            # the second sender runs a whole pass while the first one is still sending
+            second.process_messages_for_db(10, "default", self.router_url)
+            seen_while_sending.append(MessageBatch.objects.get(pk=self.batch.pk).status)
+            return 200
+
+        first.fetch_url = fetch_url
+        first.process_messages_for_db(10, "default", self.router_url)
+        self.assertEqual(set(['Q']), set(seen_while_sending))
+        self.assertEqual(['S', 'S', 'Q'], self.statuses(Message, self.messages))
+        self.assertFalse(second.fetch_url.called)
+
+        first.process_messages_for_db(10, "default", self.router_url)
+        self.assertEqual('S', MessageBatch.objects.get(pk=self.batch.pk).status)
@@ -0,0 +1,195 @@
+import json
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections
+from django.test import TestCase
+from django.test.client import RequestFactory
+from mock import patch
+from rapidsms.models import Backend, Connection
+from rapidsms_httprouter.models import Message
+from rapidsms_httprouter import views
+from rapidsms_httprouter.views import parse_bulk_messages, stream_json
+
+
+class ParseBulkMessagesTest(TestCase):
+
+    def test_json_list_is_parsed(self):
+        body = '[{"backend": "test", "sender": "256777", "message": "one"}]'
+        self.assertEqual([{"backend": "test", "sender": "256777", "message": "one"}], parse_bulk_messages(body))
+
+    def test_json_object_with_messages_is_parsed(self):
+        body = '{"messages": [{"backend": "test", "sender": "256777", "message": "one"}]}'
+        self.assertEqual(1, len(parse_bulk_messages(body)))
+
+    def test_newline_delimited_json_is_parsed(self):
+        body = '{"backend": "test", "sender": "256777", "message": "one"}\n' \
+               '{"backend": "test", "sender": "256778", "message": "two"}\n'
+        self.assertEqual(["one", "two"], [m['message'] for m in parse_bulk_messages(body)])
+
+
+class StreamJsonTest(TestCase):
+
+    def test_items_are_written_in_chunks(self):
+        chunks = list(stream_json('items', iter(range(5)), chunk_size=2, last=lambda: 4))
+        self.assertEqual(['{"items": [', '0, 1', ', 2, 3', ', 4', ']', ', "last": 4', '}'], chunks)
+
+    def test_empty_lists_are_valid(self):
+        self.assertEqual({'items': [], 'status': 'ok'},
+                         json.loads(''.join(stream_json('items', iter([]), status='ok'))))
+
+
+class ReceiveBulkViewTest(TestCase):
+
+    def test_messages_are_logged_and_handled(self):
+        body = json.dumps([{"backend": "bulk_test", "sender": "+256-777", "message": "one"},
+                           {"backend": "bulk_test", "sender": "256778", "message": "two"}])
+        response = self.client.post('/router/receive_bulk', body, content_type='application/json')
+
+        self.assertEqual(200, response.status_code)
+        ids = json.loads(response.content)['messages']
+        messages = Message.objects.filter(pk__in=ids).order_by('id')
+        self.assertEqual(['256777', '256778'], [m.connection.identity for m in messages])
+        self.assertEqual(['H', 'H'], [m.status for m in messages])
+
+    def test_request_is_rejected_if_any_message_is_invalid(self):
+        body = json.dumps([{"backend": "bulk_test", "sender": "256777", "message": "one"},
+                           {"backend": "bulk_test", "message": "no sender"}])
+        response = self.client.post('/router/receive_bulk', body, content_type='application/json')
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, Message.objects.filter(connection__backend__name="bulk_test").count())
+
+
+class OutboxViewTest(TestCase):
+
+    def setUp(self):
+        self.messages = []
+        for name in ('outbox_a', 'outbox_b'):
+            connection = Connection.objects.create(backend=Backend.objects.create(name=name), identity='256777')
+            for i in range(3):
+                self.messages.append(Message.objects.create(connection=connection, text="out %d" % i,
+                                                            direction='O', status='Q'))
+        Message.objects.create(connection=connection, text="sent", direction='O', status='S')
+
+    def get_outbox(self, query=''):
+        response = self.client.get('/router/outbox' + query)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content)
+
+    def test_whole_outbox_is_returned_without_a_limit(self):
+        outbox = self.get_outbox()
+        self.assertEqual([m.as_json() for m in self.messages], outbox['outbox'])
+        self.assertEqual(None, outbox['next_after_id'])
+
+    def test_outbox_is_paged_by_id(self):
+        first = self.get_outbox('?limit=4')
+        self.assertEqual([m.pk for m in self.messages[:4]], [m['id'] for m in first['outbox']])
+
+        second = self.get_outbox('?limit=4&after_id=%d' % first['next_after_id'])
+        self.assertEqual([m.pk for m in self.messages[4:]], [m['id'] for m in second['outbox']])
+        self.assertEqual(None, second['next_after_id'])
+
+    def test_outbox_is_filtered_by_backend(self):
+        outbox = self.get_outbox('?backend=outbox_b')
+        self.assertEqual(['outbox_b'] * 3, [m['backend'] for m in outbox['outbox']])
+
+    def test_outbox_is_read_before_the_request_finishes(self):
+        response = views.outbox(RequestFactory().get('/router/outbox', {'limit': 4}))
+        request_finished.send(sender=self.__class__)
+
+        # the server only iterates the response once the connection was closed
+        with patch.object(connections['default'], 'cursor', side_effect=AssertionError("database used")):
+            page = json.loads(''.join(response))
+
+        self.assertEqual([m.pk for m in self.messages[:4]], [m['id'] for m in page['outbox']])
+        self.assertEqual(self.messages[3].pk, page['next_after_id'])
+
+
+class DeliveredBulkViewTest(TestCase):
+
+    def setUp(self):
+        connection = Connection.objects.create(backend=Backend.objects.create(name="dlr_backend"), identity='256777')
+        self.messages = [Message.objects.create(connection=connection, text="dlr %d" % i, direction='O', status='S')
+                         for i in range(3)]
+
+    def test_receipts_are_applied_per_status(self):
+        body = json.dumps([{"id": self.messages[0].pk}, {"id": self.messages[1].pk, "status": "D"},
+                           {"id": self.messages[2].pk, "status": "E"}])
+        response = self.client.post('/router/delivered_bulk', body, content_type='application/json')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, json.loads(response.content)['updated'])
+        self.assertEqual(['D', 'D', 'E'], [Message.objects.get(pk=m.pk).status for m in self.messages])
+
+    def test_request_is_rejected_if_any_receipt_is_invalid(self):
+        body = json.dumps([{"id": self.messages[0].pk}, {"id": self.messages[1].pk, "status": "Q"}])
+        response = self.client.post('/router/delivered_bulk', body, content_type='application/json')
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(['S', 'S', 'S'], [Message.objects.get(pk=m.pk).status for m in self.messages])
+
+
+class DeliveryReportViewTest(TestCase):
+
+    def setUp(self):
+        settings.DELIVERY_USERNAME = 'kannel'
+        settings.DELIVERY_PASSWORD = 'kannel'
+        backend = Backend.objects.create(name="receipt_backend")
+        self.messages = [Message.objects.create(connection=Connection.objects.create(backend=backend, identity=identity),
+                                                text="same text", direction='O', status='S')
+                         for identity in ('256771', '256772', '256773')]
+
+    def get_report(self, query):
+        return self.client.get('/router/delivery?username=kannel&passwrd=kannel&' + query)
+
+    def statuses(self):
+        return [Message.objects.get(pk=m.pk).status for m in self.messages]
+
+    def send_chunk(self, messages):
+        # what send_messages does for every chunk it sends
+        token = Message.receipt_token([m.pk for m in messages])
+        Message.objects.filter(pk__in=[m.pk for m in messages]).update(receipt_chunk=token)
+        return token
+
+    def test_receipt_token_of_a_single_message_is_its_id(self):
+        token = Message.receipt_token([self.messages[1].pk])
+        self.assertEqual(str(self.messages[1].pk), str(token))
+        self.assertEqual(200, self.get_report('id=%s&receiver=256772' % token).status_code)
+        self.assertEqual(['S', 'D', 'S'], self.statuses())
+
+    def test_receipt_token_of_a_chunk_is_matched_with_the_receiver(self):
+        token = self.send_chunk(self.messages)
+        self.assertEqual(200, self.get_report('id=%s&receiver=256773' % token).status_code)
+        self.assertEqual(['S', 'S', 'D'], self.statuses())
+
+    def test_receivers_of_a_chunk_are_normalized(self):
+        token = self.send_chunk(self.messages)
+        self.assertEqual(200, self.get_report('id=%s&receiver=%%2B256772' % token).status_code)
+        self.assertEqual(['S', 'D', 'S'], self.statuses())
+
+    def test_only_sent_messages_of_a_chunk_are_delivered(self):
+        token = self.send_chunk(self.messages)
+        Message.objects.filter(pk=self.messages[2].pk).update(status='Q')
+        self.assertEqual(404, self.get_report('id=%s&receiver=256773' % token).status_code)
+        self.assertEqual(['S', 'S', 'Q'], self.statuses())
+
+    def test_messages_outside_of_the_chunk_are_not_delivered(self):
+        # sent to the same number in between the messages of the chunk, but in another request
+        token = self.send_chunk([self.messages[0], self.messages[2]])
+        self.send_chunk([self.messages[1]])
+        Message.objects.filter(pk=self.messages[1].pk).update(connection=self.messages[2].connection)
+
+        self.assertEqual(200, self.get_report('id=%s&receiver=256773' % token).status_code)
+        self.assertEqual(['S', 'S', 'D'], self.statuses())
+
+    def test_legacy_receipts_are_matched_on_text_and_receiver(self):
+        self.assertEqual(200, self.get_report('message=same+text&receiver=256771').status_code)
+        self.assertEqual(['D', 'S', 'S'], self.statuses())
+
+    def test_invalid_tokens_are_rejected(self):
+        self.assertEqual(400, self.get_report('id=abc&receiver=256771').status_code)
+
+        # ranges of ids are no longer accepted, they may cover other messages to the same number
+        range_token = '%d-%d' % (self.messages[0].pk, self.messages[2].pk)
+        self.assertEqual(400, self.get_report('id=%s&receiver=256771' % range_token).status_code)
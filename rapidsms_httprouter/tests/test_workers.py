@@ -0,0 +1,67 @@
+from unittest import TestCase
+from django.conf import settings
+from django.test import TestCase as DjangoTestCase
+from mock import patch, MagicMock
+from rapidsms_httprouter.views import HandleIncomingThread
+from rapidsms_httprouter.workers import IncomingWorkerPool
+
+
+class IncomingWorkerPoolTest(TestCase):
+
+    def test_messages_are_refused_when_the_queue_is_full(self):
+        pool = IncomingWorkerPool(size=0, queue_size=1)
+        self.assertTrue(pool.submit('test', '256777', 'one'))
+        self.assertFalse(pool.submit('test', '256777', 'two'))
+
+    def test_queued_messages_are_handled_before_draining_completes(self):
+        router = MagicMock()
+        with patch('rapidsms_httprouter.workers.get_router', return_value=router):
+            with patch('rapidsms_httprouter.workers.close_connection') as close_connection:
+                pool = IncomingWorkerPool(size=2, queue_size=10)
+                for i in range(5):
+                    self.assertTrue(pool.submit('test', '256777', str(i)))
+                pool.drain(timeout=5)
+
+        self.assertEqual(5, router.handle_incoming.call_count)
+        self.assertEqual(5, close_connection.call_count)
+        self.assertFalse(pool.submit('test', '256777', 'late'))
+
+
+class ReceiveBackpressureTest(DjangoTestCase):
+
+    def setUp(self):
+        settings.THREAD_MESSAGE_PROCESSING = True
+
+    def tearDown(self):
+        settings.THREAD_MESSAGE_PROCESSING = False
+
+    def test_receive_returns_503_when_the_pool_is_full(self):
+        with patch('rapidsms_httprouter.views.incoming_worker_pool') as pool:
+            pool.submit.return_value = False
+            response = self.client.get("/router/receive?backend=test&sender=256777&message=hi")
+
+        self.assertEqual(503, response.status_code)
+        self.assertTrue(response.has_header('Retry-After'))
+
+
+class HandleIncomingThreadTest(TestCase):
+
+    def setUp(self):
+        self.data = dict(backend='test', sender='256777', message='hi')
+
+    def test_messages_are_queued_on_the_pool(self):
+        with patch('rapidsms_httprouter.views.incoming_worker_pool') as pool:
+            pool.submit.return_value = True
+            with patch('rapidsms_httprouter.views.get_router') as get_router:
+                HandleIncomingThread(self.data).start()
+
+        pool.submit.assert_called_with('test', '256777', 'hi')
+        self.assertFalse(get_router.called)
+
+    def test_messages_are_handled_straight_away_when_the_pool_is_full(self):
+        with patch('rapidsms_httprouter.views.incoming_worker_pool') as pool:
+            pool.submit.return_value = False
+            with patch('rapidsms_httprouter.views.get_router') as get_router:
+                HandleIncomingThread(self.data).start()
+
+        get_router.return_value.handle_incoming.assert_called_with('test', '256777', 'hi')
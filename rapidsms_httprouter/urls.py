@@ -2,12 +2,14 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 from django.conf.urls.defaults import *
-from .views import receive, outbox, delivered, console, summary, can_send, delivery_report
+from .views import receive, receive_bulk, outbox, delivered, delivered_bulk, console, summary, can_send, delivery_report
 from django.contrib.admin.views.decorators import staff_member_required
 
 urlpatterns = patterns("",
+   ("^router/receive_bulk", receive_bulk),
    ("^router/receive", receive),
    ("^router/outbox", outbox),
+   ("^router/delivered_bulk", delivered_bulk),
    ("^router/delivered", delivered),
    ("^router/can_send/(?P<message_id>\d+)/", can_send),
    ("^router/console", staff_member_required(console), {}, 'httprouter-console'),
@@ -1,6 +1,5 @@
 from datetime import datetime
 import json
-import threading
 
 from django import forms
 from django.http import HttpResponse, Http404
@@ -9,9 +8,9 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
 from django.db.models import Count
-from django.db.models import Q
 from django.core.paginator import *
 from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_exempt
 
 from rapidsms.messages.outgoing import OutgoingMessage
 from rapidsms.models import Connection
@@ -19,8 +18,9 @@ from djtables import Table, Column
 from djtables.column import DateColumn
 
 from .models import Message
-from .router import get_router
+from .router import get_router, HttpRouter
 from .tasks import handle_incoming
+from .workers import incoming_worker_pool
 
 import logging
 
@@ -52,19 +52,29 @@ class MessageForm(SecureForm):
     echo = forms.BooleanField(required=False)
 
 
-class HandleIncomingThread(threading.Thread):
+class HandleIncomingThread(object):
+    """
+    Deprecated, receive hands messages to incoming_worker_pool instead.  Kept for code
+    which still starts one of these per message, start() queues the message on the pool
+    rather than opening a thread, and handles it straight away if the pool is full.
+    """
+
     def __init__(self, data, **kwargs):
         self.data = data
-        super(HandleIncomingThread, self).__init__(**kwargs)
+
+    def start(self):
+        if not incoming_worker_pool.submit(self.data['backend'], self.data['sender'], self.data['message']):
+            self.run()
 
     def run(self):
-        print "thread now handling incoming at %s" % str(datetime.now())
         try:
-            message = get_router().handle_incoming(self.data['backend'], self.data['sender'], self.data['message'])
+            get_router().handle_incoming(self.data['backend'], self.data['sender'], self.data['message'])
         except Exception as e:
-            print e
             log.debug(str(e))
-        print "thread done at %s" % str(datetime.now())
+
+    def join(self, timeout=None):
+        pass
+
 
 @never_cache
 def receive(request):
@@ -94,7 +104,11 @@ def receive(request):
         return HttpResponse("celery handler")
     elif getattr(settings, 'THREAD_MESSAGE_PROCESSING', None):
         log.debug("Handing off request to thread at %s" % str(datetime.now()))
-        HandleIncomingThread(data).start()
+        if not incoming_worker_pool.submit(data['backend'], data['sender'], data['message']):
+            log.error("[receive-msg] [{0}] Too many messages waiting to be handled".format(data['sender']))
+            response = HttpResponse("Too many messages waiting to be handled, try again later.", status=503)
+            response['Retry-After'] = str(getattr(settings, 'THREAD_MESSAGE_RETRY_AFTER', 5))
+            return response
         log.debug("Message is being handled but request released at %s" % str(datetime.now()))
         return HttpResponse("Message Handled")
     else:
@@ -111,25 +125,159 @@ def receive(request):
         else:
             return HttpResponse(json.dumps(response))
 
+def parse_bulk_messages(body):
+    """
+    Parses the body of a bulk receive request.  This can either be a JSON list of messages,
+    a JSON object with a 'messages' list, or one JSON message per line.
+    """
+    body = body.strip()
+    if not body:
+        return []
+
+    try:
+        messages = json.loads(body)
+    except ValueError:
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+    if isinstance(messages, dict):
+        # a single newline delimited message also parses as a JSON object
+        messages = messages['messages'] if 'messages' in messages else [messages]
+
+    return messages
+
+
+@csrf_exempt
+@never_cache
+def receive_bulk(request):
+    """
+    Takes a POST of many incoming messages, each with a backend, sender and message.  All
+    the messages are logged at once and then passed through the rapidsms applications.
+    """
+    if request.method != 'POST':
+        return HttpResponse("Messages must be POSTed", status=405)
+
+    form = SecureForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    try:
+        messages = parse_bulk_messages(request.raw_post_data)
+        if not isinstance(messages, list):
+            raise ValueError("Expected a list of messages")
+    except (ValueError, KeyError), e:
+        log.error("[receive-bulk] Invalid request body - {0}".format(str(e)))
+        return HttpResponse("Invalid request body: %s" % str(e), status=400)
+
+    to_handle = []
+    errors = {}
+    for index, data in enumerate(messages):
+        if not isinstance(data, dict):
+            errors[index] = "Expected an object with backend, sender and message"
+            continue
+
+        data = dict(data, password=form.cleaned_data.get('password'))
+        message_form = MessageForm(data)
+        if message_form.is_valid():
+            to_handle.append((message_form.cleaned_data['backend'],
+                              message_form.cleaned_data['sender'],
+                              message_form.cleaned_data['message']))
+        else:
+            errors[index] = message_form.errors
+
+    # reject the whole request so aggregators can safely retry it
+    if errors:
+        log.error("[receive-bulk] Invalid messages - {0}".format(str(errors)))
+        return HttpResponse(json.dumps(dict(status="Invalid messages.",
+                                            errors=dict((k, str(v)) for k, v in errors.items()))), status=400)
+
+    handled = get_router().handle_incoming_bulk(to_handle)
+    log.debug("[receive-bulk] [{0}] Messages handled".format(len(handled)))
+
+    return HttpResponse(json.dumps(dict(status="Messages handled.", messages=[m.pk for m in handled])))
+
+class OutboxForm(SecureForm):
+    after_id = forms.IntegerField(required=False, min_value=0)
+    limit = forms.IntegerField(required=False, min_value=1)
+    backend = forms.CharField(max_length=32, required=False)
+
+
+# the columns as_json reads, fetched with a single join instead of two queries per message
+OUTBOX_VALUES = ('id', 'connection__identity', 'connection__backend__name', 'direction', 'status', 'text', 'date')
+
+
+def values_as_json(values):
+    """
+    Same as Message.as_json, for a row of OUTBOX_VALUES.
+    """
+    return dict(id=values['id'],
+                contact=values['connection__identity'], backend=values['connection__backend__name'],
+                direction=values['direction'], status=values['status'], text=values['text'],
+                date=values['date'].isoformat())
+
+
+def stream_json(key, items, chunk_size=100, **fields):
+    """
+    Generates the JSON of an object whose key holds the passed in items, chunk_size
+    items at a time, so that large lists never have to be built in memory.  Any other
+    fields follow the items, callables are only called once all the items were written.
+    """
+    yield '{"%s": [' % key
+    separator = ''
+    chunk = []
+    for item in items:
+        chunk.append(json.dumps(item))
+        if len(chunk) >= chunk_size:
+            yield separator + ', '.join(chunk)
+            separator = ', '
+            chunk = []
+    if chunk:
+        yield separator + ', '.join(chunk)
+    yield ']'
+
+    for name, value in fields.items():
+        if callable(value):
+            value = value()
+        yield ', %s: %s' % (json.dumps(name), json.dumps(value))
+    yield '}'
+
+
 @never_cache
 def outbox(request):
     """
     Returns any messages which have been queued to be sent but have no yet been marked
     as being delivered.
+
+    The outbox can be paged through in id order by passing the next_after_id of the
+    previous page as after_id along with a limit, and filtered by backend.
     """
-    form = SecureForm(request.GET)
+    form = OutboxForm(request.GET)
     if not form.is_valid():
         return HttpResponse(str(form.errors), status=400)
 
-    response = {}
-    messages = []
-    for message in Message.objects.filter(status='Q'):
-        messages.append(message.as_json())
+    queryset = Message.objects.filter(status='Q')
+    if form.cleaned_data['after_id'] is not None:
+        queryset = queryset.filter(id__gt=form.cleaned_data['after_id'])
+    if form.cleaned_data['backend']:
+        queryset = queryset.filter(connection__backend__name=form.cleaned_data['backend'])
+
+    # without a limit the whole outbox is returned, unless ROUTER_OUTBOX_LIMIT is set
+    limit = form.cleaned_data['limit']
+    if limit:
+        limit = min(limit, getattr(settings, 'ROUTER_OUTBOX_MAX_LIMIT', 1000))
+    else:
+        limit = getattr(settings, 'ROUTER_OUTBOX_LIMIT', None)
+
+    queryset = queryset.order_by('id').values(*OUTBOX_VALUES)
+    if limit:
+        queryset = queryset[:limit]
 
-    response['outbox'] = messages
-    response['status'] = "Outbox follows."
+    # request_finished closes our connection before the response is iterated, so the rows
+    # are read now and only their JSON is written out as it is needed
+    rows = list(queryset)
+    next_after_id = rows[-1]['id'] if limit and len(rows) == limit else None
 
-    return HttpResponse(json.dumps(response))
+    return HttpResponse(stream_json('outbox', (values_as_json(values) for values in rows),
+                                    status="Outbox follows.", next_after_id=next_after_id))
 
 
 class DeliveredForm(SecureForm):
@@ -149,6 +297,49 @@ def delivered(request):
 
     return HttpResponse(json.dumps(dict(status="Message marked as sent.")))
 
+# the statuses backends may report for a message in a delivery receipt
+RECEIPT_STATUSES = ('S', 'D', 'E', 'K')
+
+
+@csrf_exempt
+@never_cache
+def delivered_bulk(request):
+    """
+    Takes a POST of many delivery receipts at once, a JSON list of objects with the id of
+    a message and optionally its status, which defaults to delivered.  Receipts are applied
+    with one update per status.
+    """
+    if request.method != 'POST':
+        return HttpResponse("Receipts must be POSTed", status=405)
+
+    form = SecureForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(str(form.errors), status=400)
+
+    try:
+        receipts = json.loads(request.raw_post_data)
+        if not isinstance(receipts, list):
+            raise ValueError("Expected a list of receipts")
+    except ValueError, e:
+        return HttpResponse("Invalid request body: %s" % str(e), status=400)
+
+    to_mark = []
+    errors = {}
+    for index, receipt in enumerate(receipts):
+        try:
+            status = receipt.get('status', 'D')
+            if status not in RECEIPT_STATUSES:
+                raise ValueError("Invalid status %s" % status)
+            to_mark.append((int(receipt['id']), status))
+        except (AttributeError, KeyError, TypeError, ValueError), e:
+            errors[index] = "Expected an object with a valid id and status: %s" % str(e)
+
+    if errors:
+        return HttpResponse(json.dumps(dict(status="Invalid receipts.", errors=errors)), status=400)
+
+    updated = get_router().mark_statuses(to_mark)
+    return HttpResponse(json.dumps(dict(status="Messages marked.", updated=updated)))
+
 @never_cache
 def can_send(request, message_id):
     message = get_object_or_404(Message, pk=message_id)
@@ -227,13 +418,7 @@ def console(request):
                 terms = search_form.cleaned_data['search'].split()
 
                 if terms:
-                    term = terms[0]
-                    query = (Q(text__icontains=term) | Q(in_response_to__text__icontains=term) | Q(
-                        connection__identity__icontains=term))
-                    for term in terms[1:]:
-                        query &= (Q(text__icontains=term) | Q(in_response_to__text__icontains=term) | Q(
-                            connection__identity__icontains=term))
-                    queryset = queryset.filter(query)
+                    queryset = queryset.search(terms)
 
     paginator = Paginator(queryset.order_by('-id'), 20)
     page = request.GET.get('page')
@@ -274,8 +459,24 @@ def delivery_report(request):
     if request.GET.get('username') != getattr(settings, 'DELIVERY_USERNAME') and request.GET.get('passwrd') != getattr(
             settings, "DELIVERY_PASSWORD"):
         return Http404
-    message = Message.objects.filter(text=request.GET.get('message'),
-                                     connection__identity=request.GET.get('receiver')).latest('date')
-    message.status = 'D'
-    message.save()
+
+    # identities are stored normalized, kannel passes receivers on as the SMSC reported them
+    receiver = HttpRouter.normalize_number(request.GET.get('receiver', ''))
+
+    # receipts for messages sent with a receipt token in their dlr url are a lookup by id
+    token = request.GET.get('id')
+    if token:
+        try:
+            messages = Message.objects.for_receipt_token(token, receiver)
+        except ValueError:
+            return HttpResponse("Invalid id", status=400)
+    else:
+        message = Message.objects.with_text(request.GET.get('message')).filter(
+            connection__identity=receiver).latest('date')
+        messages = Message.objects.filter(pk=message.pk)
+
+    if not messages.update(status='D'):
+        log.error("[delivery-report] No sent message found for id %s and receiver %s"
+                  % (token, receiver))
+        return HttpResponse(status=404)
     return HttpResponse(status=200)
\ No newline at end of file
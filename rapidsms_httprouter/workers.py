@@ -0,0 +1,101 @@
+"""
+A process wide, bounded pool of threads handling incoming messages in the background,
+used when THREAD_MESSAGE_PROCESSING is set.
+
+THREAD_MESSAGE_WORKERS threads (10 by default) handle messages waiting in a queue of at
+most THREAD_MESSAGE_QUEUE_SIZE (100 by default).  When the queue is full new messages are
+refused so that the caller can ask the backend to retry later, rather than opening ever
+more threads and database connections.
+"""
+import atexit
+import Queue
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import close_connection
+from rapidsms.log.mixin import LoggerMixin
+
+from .router import get_router
+
+
+class IncomingWorkerPool(object, LoggerMixin):
+
+    def __init__(self, size=10, queue_size=100):
+        self.size = size
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    def start(self):
+        with self.lock:
+            if self.threads or self.stopping:
+                return
+            for i in range(self.size):
+                thread = threading.Thread(target=self.work, name="httprouter-incoming-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, backend, sender, text):
+        """
+        Queues the passed in message to be handled, returns False if the queue is full or
+        we are shutting down.
+        """
+        if self.stopping:
+            return False
+
+        self.start()
+        try:
+            self.queue.put_nowait((backend, sender, text))
+            return True
+        except Queue.Full:
+            return False
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                self.handle(*task)
+            finally:
+                self.queue.task_done()
+
+    def handle(self, backend, sender, text):
+        try:
+            get_router().handle_incoming(backend, sender, text)
+        except Exception, exc:
+            self.error("Unable to handle message from %s: %s" % (sender, traceback.format_exc(exc)))
+        finally:
+            # every task may run on any of our threads, don't leave connections open between them
+            close_connection()
+
+    def drain(self, timeout=None):
+        """
+        Stops accepting messages and waits up to timeout seconds for the queued ones to be
+        handled.
+        """
+        self.stopping = True
+        with self.lock:
+            threads, self.threads = self.threads, []
+
+        deadline = None if timeout is None else time.time() + timeout
+        remaining = lambda: None if deadline is None else max(0, deadline - time.time())
+
+        try:
+            # one stop marker per thread, queued behind the waiting messages
+            for thread in threads:
+                self.queue.put(None, timeout=remaining())
+        except Queue.Full:
+            self.error("Gave up waiting for %d queued messages to be handled" % self.queue.qsize())
+            return
+
+        for thread in threads:
+            thread.join(remaining())
+
+incoming_worker_pool = IncomingWorkerPool(getattr(settings, 'THREAD_MESSAGE_WORKERS', 10),
+                                          getattr(settings, 'THREAD_MESSAGE_QUEUE_SIZE', 100))
+atexit.register(incoming_worker_pool.drain, getattr(settings, 'THREAD_MESSAGE_DRAIN_TIMEOUT', 30))